@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 
 class TestRealm(models.Model):
@@ -15,3 +17,13 @@ class TestAgent(models.Model):
     realm = models.ForeignKey(TestRealm, on_delete=models.SET_NULL, related_name='agents', null=True)
     slug = models.CharField(max_length=16)
     user = models.ForeignKey('auth.User', on_delete=models.SET_NULL, null=True)
+
+
+@receiver(post_save, sender=TestAgent)
+@receiver(post_delete, sender=TestAgent)
+def agents_changed(sender, instance, **kwargs):
+    from turngeneration import plugins
+
+    plugins.permissions_changed(instance)
+    if instance.realm_id is not None:
+        plugins.agents_changed(instance.realm)
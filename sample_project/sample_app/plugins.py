@@ -35,12 +35,31 @@ class TurnGeneration(object):
             return
         return realm.agents.all()
 
+    def related_agents_lookup(self, agent_type=None):
+        ct = ContentType.objects.get_for_model(models.TestAgent)
+        if agent_type is None:
+            agent_type = ct
+        if agent_type != ct:
+            return
+        return models.TestAgent.objects.all(), 'realm'
+
+    def agents_for_user(self, user):
+        return models.TestAgent.objects.filter(user__pk=user.pk)
+
     def _is_host(self, user, obj):
         return user.is_staff
 
     def _is_player(self, user, obj):
         return obj.user == user
 
+    def filter_permitted(self, user, perm, queryset):
+        methodname = self.permissions.get(perm)
+        if methodname == '_is_host':
+            return queryset if user.is_staff else queryset.none()
+        if methodname == '_is_player':
+            return queryset.filter(user__pk=user.pk)
+        return queryset.none()
+
     def auto_generate(self, realm):
         realm.generate()
 
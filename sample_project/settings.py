@@ -50,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'turngeneration.middleware.PluginScopeMiddleware',
 ]
 
 ROOT_URLCONF = 'sample_project.urls'
@@ -116,3 +117,7 @@ STATIC_URL = '/static/'
 
 BROKER_URL = 'django://'
 CELERY_ALWAYS_EAGER = True
+
+# Tasks run in the web process here, so the local-memory cache is shared
+# with them.
+SILENCED_SYSTEM_CHECKS = ['turngeneration.W001']
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class TurnGenerationConfig(AppConfig):
+    name = 'turngeneration'
+
+    def ready(self):
+        from . import models
+
+        models.connect_realm_signals()
@@ -1,4 +1,56 @@
-from . import plugins
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+
+from . import cache, plugins
+
+
+def permissions_key(obj):
+    ct = ContentType.objects.get_for_model(obj)
+    return '{0}.{1}'.format(ct.pk, obj.pk)
+
+
+def filter_permitted(user_obj, perm, queryset, unlisted=True):
+    """
+    Restrict `queryset` to the objects on which `user_obj` has `perm`.
+    If the plugin for its model does not list `perm` among its
+    permissions, either every object is permitted, or, with `unlisted`
+    false, none are.
+
+    Plugins may provide ``filter_permitted(user, perm, queryset)`` to
+    do this in the database; otherwise each object is checked in turn.
+
+    """
+    # As with User.has_perm(), active superusers may do anything.
+    if user_obj.is_active and user_obj.is_superuser:
+        return queryset
+
+    plugin = plugins.get_plugin_for_model(queryset.model)
+    if plugin is None or perm not in plugin.permissions:
+        return queryset if unlisted else queryset.none()
+
+    bulk_filter = getattr(plugin, 'filter_permitted', None)
+    if bulk_filter is not None:
+        return bulk_filter(user_obj, perm, queryset)
+
+    pks = [obj.pk for obj in permitted_objects(user_obj, perm, queryset)]
+    return queryset.filter(pk__in=pks)
+
+
+def filters_in_database(perm, model):
+    """
+    Whether `filter_permitted` restricts querysets of `model` for `perm`
+    without checking each object in turn.  Where it doesn't, large
+    querysets are better checked a page at a time with
+    `permitted_objects`.
+
+    """
+    plugin = plugins.get_plugin_for_model(model)
+    return (plugin is None or perm not in plugin.permissions or
+            getattr(plugin, 'filter_permitted', None) is not None)
+
+
+def permitted_objects(user_obj, perm, objects):
+    return [obj for obj in objects if user_obj.has_perm(perm, obj)]
 
 
 class TurnGenerationBackend(object):
@@ -11,6 +63,33 @@ class TurnGenerationBackend(object):
     def has_perm(self, user_obj, perm, obj=None):
         if obj is None:
             return False
+
+        # Results are memoized on the user object, which lives only as
+        # long as the request, in the way that ModelBackend caches the
+        # user's model permissions.
+        obj_key = permissions_key(obj)
+        if not hasattr(user_obj, '_turngeneration_perm_cache'):
+            user_obj._turngeneration_perm_cache = {}
+        memo = user_obj._turngeneration_perm_cache
+        if (perm, obj_key) not in memo:
+            memo[perm, obj_key] = self._cached_perm(user_obj, perm, obj,
+                                                    obj_key)
+        return memo[perm, obj_key]
+
+    def _cached_perm(self, user_obj, perm, obj, obj_key):
+        timeout = getattr(settings, 'TURNGENERATION_PERMISSION_CACHE_TIMEOUT', 0)
+        if not timeout:
+            return self._check_perm(user_obj, perm, obj)
+
+        key = '{0}:{1}:{2}'.format(cache.versioned_key('perms', obj_key),
+                                   user_obj.pk, perm)
+        result = cache.get_cache().get(key)
+        if result is None:
+            result = self._check_perm(user_obj, perm, obj)
+            cache.get_cache().set(key, result, timeout)
+        return result
+
+    def _check_perm(self, user_obj, perm, obj):
         plugin = plugins.get_plugin_for_model(obj)
         if plugin is None:
             return False
@@ -18,4 +97,4 @@ class TurnGenerationBackend(object):
         methodname = plugin.permissions.get(perm)
         if methodname is None:
             return False
-        return getattr(plugin, methodname, None)(user_obj, obj)
+        return bool(getattr(plugin, methodname, None)(user_obj, obj))
@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+
+import time
+
+
+def get_cache():
+    return caches[getattr(settings, 'TURNGENERATION_CACHE', 'default')]
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    # The web and Celery worker processes coordinate through the cache,
+    # so each of them having its own is not going to work.
+    alias = getattr(settings, 'TURNGENERATION_CACHE', 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND', '')
+    if backend != 'django.core.cache.backends.locmem.LocMemCache':
+        return []
+    return [checks.Warning(
+        "TURNGENERATION_CACHE uses a local-memory cache, which is not shared"
+        " between processes.",
+        hint="Point TURNGENERATION_CACHE at a cache shared by the web and"
+             " Celery worker processes, such as Memcached or Redis.",
+        id='turngeneration.W001',
+    )]
+
+
+def _version_key(name, pk):
+    return 'turngeneration:{0}-version:{1}'.format(name, pk)
+
+
+def _new_version():
+    # Seed versions from the clock, so that a counter evicted from the
+    # cache can't restart at a value whose entries are still cached.
+    return int(time.time() * 1000000)
+
+
+def get_version(name, pk):
+    cache = get_cache()
+    key = _version_key(name, pk)
+
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(name, pk):
+    cache = get_cache()
+    key = _version_key(name, pk)
+
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = _new_version()
+        cache.set(key, version, None)
+        return version
+
+
+def touch_versions(name, pks):
+    """
+    Replace the versions for `pks` with the current time, so that, unlike
+    with `bump_version`, a version also tells when it last changed.
+
+    """
+    version = _new_version()
+    get_cache().set_many({_version_key(name, pk): version for pk in pks},
+                         None)
+
+
+def versioned_key(name, pk):
+    return 'turngeneration:{0}:{1}:{2}'.format(name, pk, get_version(name, pk))
@@ -0,0 +1,120 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+from rest_framework import renderers
+
+import collections
+import json
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Subscription(object):
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue()
+
+    def get(self, timeout=None):
+        """
+        Return the next event, or None if there is none within `timeout`
+        seconds.
+
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(object):
+    """
+    Fans events out to the subscribers within this process only.  This
+    suits tests and single-process servers; deployments running several
+    processes need a broker backed by something shared between them,
+    such as Redis pub/sub, providing the same `publish` and `subscribe`
+    methods.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = collections.defaultdict(set)
+
+    def publish(self, channel, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.queue.put(event)
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel)
+        with self.lock:
+            self.subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.channel]
+
+
+_brokers = {}
+_lock = threading.Lock()
+
+
+def get_broker():
+    path = getattr(settings, 'TURNGENERATION_EVENTS_BROKER',
+                   'turngeneration.events.LocalBroker')
+    with _lock:
+        if path not in _brokers:
+            _brokers[path] = import_string(path)()
+        return _brokers[path]
+
+
+def channel(generator_id):
+    return 'turngeneration:events:{0}'.format(generator_id)
+
+
+def publish(generator_id, event, **data):
+    """
+    Send `event` to the subscribers of the Generator once the current
+    transaction, if any, commits.
+
+    """
+    message = {'event': event, 'data': data}
+    transaction.on_commit(
+        lambda: get_broker().publish(channel(generator_id), message))
+
+
+def subscribe(generator_id):
+    return get_broker().subscribe(channel(generator_id))
+
+
+def format_event(message):
+    return 'event: {0}\ndata: {1}\n\n'.format(
+        message['event'], json.dumps(message['data'], cls=DjangoJSONEncoder))
+
+
+class EventStreamRenderer(renderers.BaseRenderer):
+    """
+    Lets views accept requests for `text/event-stream`, rendering any
+    response other than the stream itself, such as an error, as a single
+    'error' event.
+
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_event({'event': 'error', 'data': data})
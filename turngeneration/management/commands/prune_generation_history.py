@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from ... import tasks
+
+
+class Command(BaseCommand):
+    help = ("Roll up and delete the GenerationTime entries older than the"
+            " configured retention.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-batches', type=int, default=None,
+            help="Stop after this many batches, leaving the rest for later.")
+
+    def handle(self, *args, **options):
+        pruned = tasks.prune_generation_history(
+            max_batches=options['max_batches'])
+        self.stdout.write("Pruned {0} generation time(s).".format(pruned))
@@ -0,0 +1,14 @@
+from . import plugins
+
+
+class PluginScopeMiddleware(object):
+    """
+    Shares instances of stateful plugins across a single request.
+
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with plugins.plugin_scope():
+            return self.get_response(request)
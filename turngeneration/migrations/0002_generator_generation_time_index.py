@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turngeneration', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='generator',
+            name='generation_time',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_readies(apps, schema_editor):
+    Generator = apps.get_model('turngeneration', 'Generator')
+    Ready = apps.get_model('turngeneration', 'Ready')
+
+    counts = Ready.objects.values('generator').annotate(n=models.Count('pk'))
+    for row in counts:
+        Generator.objects.filter(pk=row['generator']).update(
+            ready_count=row['n'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turngeneration', '0002_generator_generation_time_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generator',
+            name='agent_count',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='generator',
+            name='ready_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        # The agent counts are left null, to be filled in on demand.
+        migrations.RunPython(count_readies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def convert_generating(apps, schema_editor):
+    Generator = apps.get_model('turngeneration', 'Generator')
+
+    # There's no telling whether these are still alive, so give them
+    # leases that have already expired and are free to be reclaimed.
+    Generator.objects.filter(generating=True).update(
+        lock_owner='migrated', lock_expires=timezone.now())
+
+
+def convert_lease(apps, schema_editor):
+    Generator = apps.get_model('turngeneration', 'Generator')
+
+    Generator.objects.exclude(lock_owner='').update(generating=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turngeneration', '0003_generator_ready_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generator',
+            name='lock_expires',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='generator',
+            name='lock_owner',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.RunPython(convert_generating, convert_lease),
+        migrations.RemoveField(
+            model_name='generator',
+            name='generating',
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Only PostgreSQL can make use of this: SQLite can't match a partial
+# index against the bound parameters Django queries it with, and MySQL
+# has no partial indexes.  Elsewhere the generation_time index serves.
+DUE_INDEX = 'turngeneration_generator_due'
+
+
+def create_due_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute(
+        "CREATE INDEX {0} ON turngeneration_generator (generation_time)"
+        " WHERE force_generate AND task_id = ''".format(DUE_INDEX))
+
+
+def drop_due_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute("DROP INDEX IF EXISTS {0}".format(DUE_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turngeneration', '0004_generator_lease'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='generationtime',
+            index_together=set([('generator', 'timestamp')]),
+        ),
+        migrations.RunPython(create_due_index, drop_due_index),
+    ]
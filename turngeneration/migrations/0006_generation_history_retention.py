@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turngeneration', '0005_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generator',
+            name='history_retention',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+        migrations.CreateModel(
+            name='GenerationCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('generator', models.ForeignKey(related_name='counts', to='turngeneration.Generator', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+            options={
+                'unique_together': set([('generator', 'date')]),
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def backfill_last_generated_at(apps, schema_editor):
+    Generator = apps.get_model('turngeneration', 'Generator')
+    GenerationTime = apps.get_model('turngeneration', 'GenerationTime')
+
+    latest = GenerationTime.objects.order_by().values_list(
+        'generator').annotate(latest=models.Max('timestamp'))
+    for pk, timestamp in latest:
+        Generator.objects.filter(pk=pk).update(last_generated_at=timestamp)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turngeneration', '0006_generation_history_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generator',
+            name='last_generated_at',
+            field=models.DateTimeField(null=True, editable=False),
+        ),
+        migrations.RunPython(backfill_last_generated_at,
+                             migrations.RunPython.noop),
+    ]
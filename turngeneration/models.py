@@ -1,28 +1,154 @@
+import django
 from django.contrib.contenttypes import fields
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.validators import validate_comma_separated_integer_list
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 
-from celery import current_app as celery
 from dateutil import rrule
 import datetime
 import pytz
 import logging
 
-from . import tasks
+from . import cache, events, tasks
 
 logger = logging.getLogger(__name__)
 
 
+# Length in seconds of a single period for the frequencies whose
+# occurrences are evenly spaced in (naive, UTC) time.
+FIXED_PERIODS = {
+    rrule.WEEKLY: 7 * 24 * 60 * 60,
+    rrule.DAILY: 24 * 60 * 60,
+    rrule.HOURLY: 60 * 60,
+    rrule.MINUTELY: 60,
+}
+
+
+def next_occurrence(freq, kwargs, cutoff):
+    """
+    Return the first occurrence strictly after `cutoff` of the rrule
+    described by `freq` and `kwargs`, or None if there isn't one.
+
+    Rules with a fixed period and none of the `by*` fields set are
+    computed arithmetically, instead of by having dateutil iterate
+    forward from `dtstart`.  Everything else falls back to dateutil.
+
+    """
+    period = FIXED_PERIODS.get(freq)
+    interval = kwargs.get('interval', 1)
+    simple = (period is not None and interval and 'dtstart' in kwargs and
+              set(kwargs) <= {'dtstart', 'interval', 'count', 'until'})
+    if not simple:
+        return rrule.rrule(freq, **kwargs).after(cutoff)
+
+    # dateutil discards microseconds from dtstart, so do the same.
+    dtstart = kwargs['dtstart'].replace(microsecond=0)
+    step = period * interval
+
+    delta = cutoff - dtstart
+    n = max((delta.days * 86400 + delta.seconds) // step + 1, 0)
+    if 'count' in kwargs and n >= kwargs['count']:
+        return
+
+    occurrence = dtstart + datetime.timedelta(seconds=n * step)
+    if 'until' in kwargs and occurrence > kwargs['until']:
+        return
+    return occurrence
+
+
+class GeneratorQuerySet(models.QuerySet):
+    def unlocked(self):
+        """
+        Generators without a live generation lease, i.e. ones that have
+        never been locked or whose lease has expired.
+
+        """
+        return self.filter(models.Q(lock_owner='') |
+                           models.Q(lock_expires__lte=timezone.now()))
+
+    def annotate_ready(self):
+        """
+        Annotate each Generator with `agents_total`, `agents_ready` and
+        `ready`, all computed in the database rather than taken from
+        the denormalized counters.
+
+        This relies on the plugin for each realm type providing
+        `related_agents_lookup()`; Generators for realm types whose
+        plugin does not are annotated as having no agents.  Requires
+        Django 1.11 or later.
+
+        """
+        if django.VERSION < (1, 11):
+            raise NotImplementedError(
+                "annotate_ready() requires Django 1.11 or later.")
+
+        from django.db.models import (BooleanField, Case, Count, Exists, F,
+                                      IntegerField, OuterRef, Subquery,
+                                      Value, When)
+        from django.db.models.functions import Coalesce
+        from . import plugins
+
+        def count(queryset, field):
+            return Coalesce(
+                Subquery(queryset.order_by().values(field)
+                         .annotate(n=Count('pk')).values('n'),
+                         output_field=IntegerField()),
+                0
+            )
+
+        agent_whens, ready_whens = [], []
+        for realm_ct in plugins.all_realm_types():
+            plugin = plugins.get_plugin(
+                '{ct.app_label}.{ct.model}'.format(ct=realm_ct))
+            if not hasattr(plugin, 'related_agents_lookup'):
+                continue
+            lookup = plugin.related_agents_lookup()
+            if lookup is None:
+                continue
+
+            agents, field = lookup
+            agent_ct = ContentType.objects.get_for_model(agents.model)
+            agents = agents.filter(**{field: OuterRef('object_id')}).annotate(
+                _ready=Exists(Ready.objects.filter(
+                    content_type=agent_ct, object_id=OuterRef('pk'),
+                    generator__content_type=realm_ct,
+                    generator__object_id=OuterRef(field)))
+            )
+
+            agent_whens.append(
+                When(content_type=realm_ct, then=count(agents, field)))
+            ready_whens.append(
+                When(content_type=realm_ct,
+                     then=count(agents.filter(_ready=True), field)))
+
+        return self.annotate(
+            agents_total=Case(*agent_whens, default=Value(0),
+                              output_field=IntegerField()),
+            agents_ready=Case(*ready_whens, default=Value(0),
+                              output_field=IntegerField()),
+        ).annotate(
+            ready=Case(When(agents_total__gt=0,
+                            agents_ready=F('agents_total'), then=Value(True)),
+                       default=Value(False), output_field=BooleanField())
+        )
+
+
 class Generator(models.Model):
     content_type = models.ForeignKey("contenttypes.ContentType", on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
     realm = fields.GenericForeignKey()
 
-    generating = models.BooleanField(default=False, blank=True)
+    # A lease on generating, held by the task whose token is in
+    # lock_owner until lock_expires unless extended by heartbeats.
+    lock_owner = models.CharField(max_length=64, blank=True, editable=False)
+    lock_expires = models.DateTimeField(null=True, editable=False)
 
-    generation_time = models.DateTimeField(null=True)
+    generation_time = models.DateTimeField(null=True, db_index=True)
     task_id = models.TextField()
 
     force_generate = models.BooleanField(default=True, blank=True)
@@ -31,6 +157,27 @@ class Generator(models.Model):
     minimum_between_generations = models.PositiveIntegerField(
         null=True, blank=True)
 
+    # Set along with releasing the generation lease, so that tasks can
+    # check minimum_between_generations without querying GenerationTime.
+    last_generated_at = models.DateTimeField(null=True, editable=False)
+
+    # Days of GenerationTime history to keep, overriding
+    # TURNGENERATION_HISTORY_RETENTION; older entries are rolled up into
+    # GenerationCount.
+    history_retention = models.PositiveIntegerField(null=True, blank=True)
+
+    # Maintained with atomic UPDATEs as Ready rows come and go and as
+    # turns roll over.  A null agent_count has yet to be counted.
+    ready_count = models.PositiveIntegerField(default=0, editable=False)
+    agent_count = models.PositiveIntegerField(null=True, editable=False)
+
+    # Fields that save() must never write back from a stale instance.
+    _db_managed_fields = ('ready_count', 'agent_count',
+                          'lock_owner', 'lock_expires', 'last_generated_at')
+    _schedule_fields = ('task_id', 'generation_time')
+
+    objects = GeneratorQuerySet.as_manager()
+
     class Meta:
         unique_together = ('content_type', 'object_id')
 
@@ -38,35 +185,173 @@ class Generator(models.Model):
         from . import plugins
         plugin = plugins.get_plugin_for_model(self.realm)
 
-        readies = set(ready.agent for ready in self.readies.all())
-        if not readies:
-            return False
         agents = plugin.related_agents(self.realm)
-        if not agents:
+        if agents is None:
             return False
 
-        return all(agent in readies for agent in agents)
+        if not isinstance(agents, models.QuerySet):
+            agents = list(agents)
+            readies = set(
+                self.readies.values_list('content_type_id', 'object_id'))
+            return bool(agents) and all(
+                (ContentType.objects.get_for_model(agent).pk, agent.pk)
+                in readies for agent in agents
+            )
+
+        # Compare the agents against the Ready rows in the database,
+        # rather than dereferencing each Ready's agent.
+        ct = ContentType.objects.get_for_model(agents.model)
+        readies = self.readies.filter(content_type=ct).values('object_id')
+        return agents.exists() and not agents.exclude(pk__in=readies).exists()
 
     def save(self, *args, **kwargs):
+        scheduled = rescheduled = False
         if self.autogenerate and self.is_ready():
-            tasks.ready_generation.apply_async((self.pk,))
-        elif self.force_generate and not self.task_id:
+            tasks.dispatch_ready_generation(self.pk)
+        elif (self.force_generate and not self.task_id
+              and self.generation_time is None):
             eta = self.next_time()
             if eta is not None:
-                task_id = tasks.timed_generation.apply_async(
-                    (self.pk,), eta=eta).id
+                task_id = tasks.schedule_timed_generation(self.pk, eta)
                 self.task_id, self.generation_time = task_id, eta
-        elif not self.force_generate and self.task_id:
-            celery.control.revoke(self.task_id)
+                scheduled = rescheduled = True
+        elif not self.force_generate and (self.task_id or self.generation_time):
+            tasks.revoke(self.task_id)
             self.task_id, self.generation_time = '', None
+            rescheduled = True
+
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # The tasks move the schedule on as they run, so only write
+            # it back if it was changed here, rather than restoring a
+            # consumed task id from a stale instance.
+            excluded = self._db_managed_fields
+            if not rescheduled:
+                excluded += self._schedule_fields
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in excluded
+            ]
 
         super(Generator, self).save(*args, **kwargs)
 
+        # Only queue the task once its id is committed, so that it can't
+        # start up and mistake itself for having been superseded.
+        if scheduled:
+            pk, task_id, eta = self.pk, self.task_id, self.generation_time
+            transaction.on_commit(
+                lambda: tasks.dispatch_timed_generation(pk, task_id, eta))
+
+    @property
+    def generating(self):
+        return bool(self.lock_owner and self.lock_expires and
+                    self.lock_expires > timezone.now())
+
+    def count_agents(self):
+        from . import plugins
+        plugin = plugins.get_plugin_for_model(self.realm)
+
+        agents = plugin.related_agents(self.realm)
+        if agents is None:
+            return 0
+        if isinstance(agents, models.QuerySet):
+            return agents.count()
+        return len(list(agents))
+
+    def refresh_agent_count(self):
+        self.agent_count = self.count_agents()
+        Generator.objects.filter(pk=self.pk).update(
+            agent_count=self.agent_count)
+        return self.agent_count
+
+    def trigger_if_ready(self):
+        """
+        Queue up an auto-generation if it is enabled and, going by the
+        ready counters, every agent is ready.
+
+        """
+        autogenerate, ready_count, agent_count = Generator.objects.filter(
+            pk=self.pk).values_list(
+                'autogenerate', 'ready_count', 'agent_count').get()
+        if agent_count is None:
+            agent_count = self.refresh_agent_count()
+
+        if autogenerate and 0 < agent_count <= ready_count:
+            logger.debug(
+                "Triggering autogeneration for: {0}".format(self.pk))
+            tasks.dispatch_ready_generation(self.pk)
+
+    def mark_ready(self, agent_type, object_ids, user=None):
+        """
+        Mark the agents of `agent_type` with the given ids ready, with a
+        single insert, then check just once whether that makes every
+        agent ready.  Returns the number of agents newly marked.
+
+        """
+        with transaction.atomic():
+            existing = set(self.readies.filter(
+                content_type=agent_type, object_id__in=object_ids
+            ).values_list('object_id', flat=True))
+            readies = [
+                Ready(generator=self, content_type=agent_type,
+                      object_id=object_id, user=user)
+                for object_id in sorted(set(object_ids) - existing)
+            ]
+            Ready.objects.bulk_create(readies)
+            Generator.objects.filter(pk=self.pk).update(
+                ready_count=models.F('ready_count') + len(readies))
+
+        state_changed([self])
+        for ready in readies:
+            events.publish(self.pk, 'ready',
+                           content_type=agent_label(agent_type.pk),
+                           object_id=ready.object_id, ready=True)
+        self.trigger_if_ready()
+        return len(readies)
+
+    def mark_unready(self, agent_type, object_ids):
+        """
+        Clear the readies of the agents of `agent_type` with the given
+        ids, returning the number cleared.
+
+        """
+        with transaction.atomic():
+            readies = self.readies.filter(
+                content_type=agent_type, object_id__in=object_ids)
+            cleared = list(readies.values_list('object_id', flat=True))
+            count, _ = readies.delete()
+            Generator.objects.filter(pk=self.pk).update(
+                ready_count=Greatest(models.F('ready_count') - count, 0))
+
+        state_changed([self])
+        for object_id in cleared:
+            events.publish(self.pk, 'ready',
+                           content_type=agent_label(agent_type.pk),
+                           object_id=object_id, ready=False)
+        return count
+
+    @property
+    def compiled_rules(self):
+        """
+        The (freq, kwargs) pairs for this Generator's rules, cached
+        until one of the rules is saved or deleted.
+
+        """
+        if self.pk is None:
+            return []
+
+        key = cache.versioned_key('rules', self.pk)
+        compiled = cache.get_cache().get(key)
+        if compiled is None:
+            compiled = [(rule.freq, rule.rrule_kwargs)
+                        for rule in self.rules.all()]
+            cache.get_cache().set(key, compiled)
+        return compiled
+
     @property
     def rruleset(self):
         rset = rrule.rruleset()
-        for rule in self.rules.all():
-            rset.rrule(rule.rrule)
+        for freq, kwargs in self.compiled_rules:
+            rset.rrule(rrule.rrule(freq, **kwargs))
 
         return rset
 
@@ -74,9 +359,11 @@ class Generator(models.Model):
         if cutoff is None:
             cutoff = datetime.datetime.utcnow()
 
-        nexttime = self.rruleset.after(cutoff)
-        if nexttime is not None:
-            return pytz.utc.localize(nexttime)
+        times = [next_occurrence(freq, kwargs, cutoff)
+                 for freq, kwargs in self.compiled_rules]
+        times = [t for t in times if t is not None]
+        if times:
+            return pytz.utc.localize(min(times))
 
     @property
     def last_generation(self):
@@ -86,6 +373,70 @@ class Generator(models.Model):
             return
 
 
+def state_key(content_type_id, object_id):
+    return '{0}.{1}'.format(content_type_id, object_id)
+
+
+def agent_label(content_type_id):
+    ct = ContentType.objects.get_for_id(content_type_id)
+    return '{ct.app_label}.{ct.model}'.format(ct=ct)
+
+
+def state_changed(generators):
+    """
+    Record a change to the state of `generators`, or to their rules,
+    readies or pauses, for the ETags and Last-Modified times of the
+    views.  The versions are keyed by realm, to be read without a query.
+
+    """
+    cache.touch_versions('state', [state_key(g.content_type_id, g.object_id)
+                                   for g in generators])
+
+
+def touch_realm(sender, instance, **kwargs):
+    ct = ContentType.objects.get_for_model(sender)
+    cache.touch_versions('state', [state_key(ct.pk, instance.pk)])
+
+
+def connect_realm_signals():
+    """
+    Touch the state version of each realm as it is saved or deleted, so
+    that the views' ETags and cached responses follow the realm itself
+    as well as its turn generation state.
+
+    """
+    from . import plugins
+
+    for model in plugins.realm_models():
+        for signal in (post_save, post_delete):
+            signal.connect(touch_realm, sender=model,
+                           dispatch_uid='turngeneration.touch_realm')
+
+
+@receiver(post_save, sender=Generator)
+@receiver(post_delete, sender=Generator)
+def touch_generator(sender, instance, **kwargs):
+    state_changed([instance])
+
+
+@receiver(post_save, sender=Generator)
+def publish_generator(sender, instance, **kwargs):
+    events.publish(instance.pk, 'generator',
+                   generation_time=instance.generation_time,
+                   force_generate=instance.force_generate,
+                   autogenerate=instance.autogenerate,
+                   allow_pauses=instance.allow_pauses)
+
+
+@receiver(post_save, sender=Generator)
+def invalidate_new_generator(sender, instance, created, **kwargs):
+    # Guard against a new Generator inheriting the cached state of a
+    # deleted one whose pk has been reused.
+    if created:
+        cache.bump_version('rules', instance.pk)
+        cache.get_cache().delete(tasks.ready_pending_key(instance.pk))
+
+
 class GenerationTime(models.Model):
     generator = models.ForeignKey(Generator, on_delete=models.CASCADE, related_name='timestamps')
     timestamp = models.DateTimeField(auto_now=True)
@@ -93,6 +444,27 @@ class GenerationTime(models.Model):
     class Meta:
         ordering = ['-timestamp']
         get_latest_by = "timestamp"
+        index_together = [('generator', 'timestamp')]
+
+
+class GenerationCount(models.Model):
+    """
+    The number of generations a Generator had on a given day, rolled up
+    from GenerationTime entries as they are pruned.
+
+    """
+    generator = models.ForeignKey(Generator, on_delete=models.CASCADE, related_name='counts')
+    date = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('generator', 'date')
+
+
+@receiver(post_save, sender=GenerationTime)
+def touch_generated(sender, instance, created, **kwargs):
+    if created:
+        state_changed(Generator.objects.filter(pk=instance.generator_id))
 
 
 # FIXME: when a new one is saved and the generator doesn't already
@@ -132,7 +504,7 @@ class GenerationRule(models.Model):
     # ignore bysecond and byeaster
 
     @property
-    def rrule(self):
+    def rrule_kwargs(self):
         kwargs = {}
         datetime_fields = ('dtstart', 'until')
         comma_fields = ('bysetpos', 'bymonth', 'bymonthday', 'byyearday',
@@ -149,7 +521,18 @@ class GenerationRule(models.Model):
                 continue
             kwargs[field] = value
 
-        return rrule.rrule(self.freq, **kwargs)
+        return kwargs
+
+    @property
+    def rrule(self):
+        return rrule.rrule(self.freq, **self.rrule_kwargs)
+
+
+@receiver(post_save, sender=GenerationRule)
+@receiver(post_delete, sender=GenerationRule)
+def invalidate_rules(sender, instance, **kwargs):
+    cache.bump_version('rules', instance.generator_id)
+    events.publish(instance.generator_id, 'rules')
 
 
 class Pause(models.Model):
@@ -166,6 +549,24 @@ class Pause(models.Model):
         unique_together = ('content_type', 'object_id', 'generator')
 
 
+@receiver(post_save, sender=GenerationRule)
+@receiver(post_delete, sender=GenerationRule)
+@receiver(post_save, sender=Pause)
+@receiver(post_delete, sender=Pause)
+def touch_parent_generator(sender, instance, **kwargs):
+    state_changed(Generator.objects.filter(pk=instance.generator_id))
+
+
+@receiver(post_save, sender=Pause)
+@receiver(post_delete, sender=Pause)
+def publish_pause(sender, instance, **kwargs):
+    paused = kwargs.get('signal') is post_save
+    events.publish(instance.generator_id, 'pause',
+                   content_type=agent_label(instance.content_type_id),
+                   object_id=instance.object_id, paused=paused,
+                   reason=instance.reason if paused else '')
+
+
 class Ready(models.Model):
     content_type = models.ForeignKey("contenttypes.ContentType", on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
@@ -179,9 +580,27 @@ class Ready(models.Model):
         unique_together = ('content_type', 'object_id', 'generator')
 
     def save(self, *args, **kwargs):
-        super(Ready, self).save(*args, **kwargs)
-
-        if self.generator.autogenerate and self.generator.is_ready():
-            logger.debug(
-                "Triggering autogeneration for: {0}".format(self.generator.pk))
-            result = tasks.ready_generation.apply_async((self.generator.pk,))
+        adding = self._state.adding
+        with transaction.atomic():
+            super(Ready, self).save(*args, **kwargs)
+            if adding:
+                Generator.objects.filter(pk=self.generator_id).update(
+                    ready_count=models.F('ready_count') + 1)
+
+        state_changed([self.generator])
+        events.publish(self.generator_id, 'ready',
+                       content_type=agent_label(self.content_type_id),
+                       object_id=self.object_id, ready=True)
+        self.generator.trigger_if_ready()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super(Ready, self).delete(*args, **kwargs)
+            Generator.objects.filter(
+                pk=self.generator_id, ready_count__gt=0
+            ).update(ready_count=models.F('ready_count') - 1)
+        state_changed(Generator.objects.filter(pk=self.generator_id))
+        events.publish(self.generator_id, 'ready',
+                       content_type=agent_label(self.content_type_id),
+                       object_id=self.object_id, ready=False)
+        return result
@@ -0,0 +1,21 @@
+from django.conf import settings
+
+from rest_framework import pagination
+
+
+class CursorPagination(pagination.CursorPagination):
+    """
+    Pages through a list by position in a fixed ordering, the primary
+    key unless the view's `get_cursor_ordering()` says otherwise, so that
+    later pages don't cost an ever larger OFFSET scan.
+
+    """
+    ordering = 'pk'
+
+    def get_page_size(self, request):
+        return getattr(settings, 'TURNGENERATION_PAGE_SIZE', 100)
+
+    def get_ordering(self, request, queryset, view):
+        if hasattr(view, 'get_cursor_ordering'):
+            self.ordering = view.get_cursor_ordering()
+        return super(CursorPagination, self).get_ordering(request, queryset, view)
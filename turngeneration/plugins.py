@@ -1,76 +1,217 @@
+from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
-from pkg_resources import iter_entry_points
 
+import contextlib
+import threading
 
-OVERRIDES = getattr(settings, 'TURNGENERATION_OVERRIDES', {})
+from . import cache
 
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    from pkg_resources import iter_entry_points
+else:
+    def iter_entry_points(group):
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            return eps.select(group=group)
+        return eps.get(group, [])
+
+
+# Populated on first use from the 'turngeneration.plugins' entry
+# points.  The realm and agent types map aliases to 'app_label.model'
+# labels, which are only resolved to ContentTypes when asked for.
 _realm_types = {}
 _agent_types = {}
 _plugins = {}
 
+_populated = False
+_lock = threading.RLock()
 
-def _populate_realms():
-    if not _realm_types:
-        for ep in iter_entry_points('turngeneration.plugins'):
-            plugin = ep.load()
-            plugin_realm_types = dict(getattr(plugin, 'realm_types', {}))
-            plugin_realm_types.update(
-                OVERRIDES.get(ep.name, {}).get('realm_types', {})
-            )
-
-            _realm_types.update(
-                (alias, ContentType.objects.get_by_natural_key(*ct.split('.')))
-                for alias, ct in plugin_realm_types.items()
-                if ct
-            )
-
-            _plugins.update(
-                (ct, plugin)
-                for alias, ct in plugin_realm_types.items()
-                if ct
-            )
-
-
-def _populate_agents():
-    if not _agent_types:
+# Plugin instances live for the life of the process, apart from those
+# of plugins declaring `stateful = True`, which live for the current
+# scope (a request or task) instead.
+_instances = {}
+_local = threading.local()
+
+
+def _populate():
+    global _populated
+    if _populated:
+        return
+
+    with _lock:
+        if _populated:
+            return
+
+        overrides = getattr(settings, 'TURNGENERATION_OVERRIDES', {})
         for ep in iter_entry_points('turngeneration.plugins'):
             plugin = ep.load()
-            plugin_agent_types = dict(getattr(plugin, 'agent_types', {}))
-            plugin_agent_types.update(
-                OVERRIDES.get(ep.name, {}).get('agent_types', {})
-            )
+            for attr, registry in (('realm_types', _realm_types),
+                                   ('agent_types', _agent_types)):
+                types = dict(getattr(plugin, attr, {}))
+                types.update(overrides.get(ep.name, {}).get(attr, {}))
 
-            _agent_types.update(
-                (alias, ContentType.objects.get_by_natural_key(*ct.split('.')))
-                for alias, ct in plugin_agent_types.items()
-                if ct
-            )
+                types = dict((alias, ct) for alias, ct in types.items() if ct)
 
-            _plugins.update(
-                (ct, plugin)
-                for alias, ct in plugin_agent_types.items()
-                if ct
-            )
+                registry.update(types)
+                _plugins.update((ct, plugin) for ct in types.values())
+
+        _populated = True
+
+
+def _content_type(label):
+    # The ContentType manager caches natural key lookups itself.
+    return ContentType.objects.get_by_natural_key(*label.split('.'))
 
 
 def realm_type(alias):
-    return _realm_types.get(alias)
+    _populate()
+    label = _realm_types.get(alias)
+    return None if label is None else _content_type(label)
 
 
 def agent_type(alias):
-    return _agent_types.get(alias)
+    _populate()
+    label = _agent_types.get(alias)
+    return None if label is None else _content_type(label)
+
+
+def all_realm_types():
+    _populate()
+    return [_content_type(label) for label in _realm_types.values()]
+
+
+def realm_models():
+    """
+    Return the realm model classes, without touching the database, so
+    that this can be used while the app registry is being set up.
+
+    """
+    _populate()
+    return [apps.get_model(label) for label in sorted(set(_realm_types.values()))]
+
+
+def _setup(plugin):
+    instance = plugin()
+    if hasattr(instance, 'setup'):
+        instance.setup()
+    return instance
+
+
+def _teardown(instances):
+    for instance in instances:
+        if hasattr(instance, 'teardown'):
+            instance.teardown()
+
+
+def begin_scope():
+    if getattr(_local, 'depth', 0) == 0:
+        _local.scope = {}
+    _local.depth = getattr(_local, 'depth', 0) + 1
+
+
+def end_scope():
+    _local.depth -= 1
+    if _local.depth == 0:
+        scope, _local.scope = _local.scope, None
+        _teardown(scope.values())
+
+
+@contextlib.contextmanager
+def plugin_scope():
+    """
+    Share instances of stateful plugins for the duration of the block,
+    tearing them down at the end.  Nested scopes join the outermost.
+
+    """
+    begin_scope()
+    try:
+        yield
+    finally:
+        end_scope()
+
+
+def reset():
+    """
+    Tear down and discard the process-wide plugin instances.
+
+    """
+    with _lock:
+        instances = list(_instances.values())
+        _instances.clear()
+    _teardown(instances)
 
 
 def get_plugin(name):
+    _populate()
     plugin = _plugins.get(name)
-    return None if plugin is None else plugin()
+    if plugin is None:
+        return None
+
+    if getattr(plugin, 'stateful', False):
+        # Nothing would tear down an instance handed out unscoped.
+        scope = getattr(_local, 'scope', None)
+        if scope is None:
+            raise RuntimeError(
+                "The stateful plugin for {0!r} can only be used within"
+                " turngeneration.plugins.plugin_scope().".format(name))
+        if plugin not in scope:
+            scope[plugin] = _setup(plugin)
+        return scope[plugin]
+
+    instance = _instances.get(plugin)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(plugin)
+            if instance is None:
+                instance = _instances[plugin] = _setup(plugin)
+    return instance
+
+
+def all_plugins():
+    """
+    Return an instance of each registered plugin.
+
+    """
+    _populate()
+    labels = {}
+    for label in sorted(_plugins):
+        labels.setdefault(_plugins[label], label)
+    return [get_plugin(label) for label in sorted(labels.values())]
+
+
+def agents_changed(realm):
+    """
+    To be called by plugins whenever agents join or leave `realm`, so
+    that its Generator's agent count stays accurate.
+
+    """
+    from . import models
+
+    ct = ContentType.objects.get_for_model(realm)
+    cache.touch_versions('state', [models.state_key(ct.pk, realm.pk)])
+    for generator in models.Generator.objects.filter(content_type=ct,
+                                                     object_id=realm.pk):
+        generator.realm = realm
+        generator.refresh_agent_count()
+        generator.trigger_if_ready()
+
+
+def permissions_changed(obj):
+    """
+    To be called by plugins whenever a change to `obj`, such as a new
+    owner, alters who has permissions on it.  Only needed when
+    permission checks are cached across requests.
+
+    """
+    from . import backends
+
+    cache.bump_version('perms', backends.permissions_key(obj))
 
 
 def get_plugin_for_model(obj):
     ct = '{0}.{1}'.format(obj._meta.app_label, obj._meta.model_name)
     return get_plugin(ct)
 
-
-_populate_realms()
-_populate_agents()
@@ -38,6 +38,22 @@ class GeneratorSerializer(serializers.ModelSerializer):
         read_only_fields = ('generating', 'generation_time')
 
 
+class GeneratorStatusSerializer(serializers.ModelSerializer):
+    pause_count = serializers.IntegerField(read_only=True)
+
+    class Meta(object):
+        model = models.Generator
+        fields = ('generating', 'generation_time', 'force_generate',
+                  'autogenerate', 'allow_pauses', 'ready_count',
+                  'agent_count', 'pause_count')
+        read_only_fields = fields
+
+
+class RealmStatusSerializer(serializers.Serializer):
+    object_id = serializers.IntegerField()
+    generator = GeneratorStatusSerializer(allow_null=True)
+
+
 class RealmSerializer(serializers.Serializer):
     content_type = serializers.SerializerMethodField()
     object_id = serializers.IntegerField(source='pk')
@@ -49,6 +65,15 @@ class RealmSerializer(serializers.Serializer):
         return u'{ct.app_label}.{ct.model}'.format(ct=ct)
 
     def get_generator(self, obj):
+        # The view may load the Generators of a whole page of realms up
+        # front, keyed by object_id, to save a query per realm.
+        generators = self.context.get('generators')
+        if generators is not None:
+            generator = generators.get(obj.pk)
+            if generator is None:
+                return None
+            return GeneratorSerializer(generator).data
+
         ct = ContentType.objects.get_for_model(obj)
         try:
             generator = models.Generator.objects.get(
@@ -122,6 +147,13 @@ class ReadySerializer(serializers.ModelSerializer):
         ]
 
 
+class BulkReadySerializer(serializers.Serializer):
+    agent_type = serializers.CharField()
+    agents = serializers.ListField(child=serializers.IntegerField(),
+                                   allow_empty=False)
+    ready = serializers.BooleanField(default=True)
+
+
 class AgentSerializer(serializers.Serializer):
     content_type = serializers.SerializerMethodField()
     object_id = serializers.IntegerField(source='pk')
@@ -134,20 +166,37 @@ class AgentSerializer(serializers.Serializer):
         ct = ContentType.objects.get_for_model(obj)
         return u'{ct.app_label}.{ct.model}'.format(ct=ct)
 
-    def get_pause(self, obj):
+    def _lookup(self, obj, name, model):
+        # The view may load every row of the Generator up front, keyed by
+        # (content_type_id, object_id), to save a query per agent.
         ct = ContentType.objects.get_for_model(obj)
-        try:
-            pause = models.Pause.objects.get(content_type=ct, object_id=obj.pk)
-        except models.Pause.DoesNotExist:
+        rows = self.context.get(name)
+        if rows is not None:
+            return rows.get((ct.pk, obj.pk))
+
+        filters = {'content_type': ct, 'object_id': obj.pk}
+        if 'generator' in self.context:
+            filters['generator'] = self.context['generator']
+        return model.objects.filter(**filters).first()
+
+    def get_pause(self, obj):
+        pause = self._lookup(obj, 'pauses', models.Pause)
+        if pause is None:
             return None
 
         return PauseSerializer(pause).data
 
     def get_ready(self, obj):
-        ct = ContentType.objects.get_for_model(obj)
-        try:
-            ready = models.Ready.objects.get(content_type=ct, object_id=obj.pk)
-        except models.Ready.DoesNotExist:
+        ready = self._lookup(obj, 'readies', models.Ready)
+        if ready is None:
             return None
 
         return ReadySerializer(ready).data
+
+
+class UserAgentSerializer(AgentSerializer):
+    realm = serializers.SerializerMethodField()
+
+    def get_realm(self, obj):
+        realm = self.context['realms'][obj.pk]
+        return RealmSerializer(realm, context=self.context).data
@@ -1,18 +1,441 @@
 from django.conf import settings
-from celery import shared_task, current_app
+from django.db import connection, transaction
+from django.db.models import Case, DateTimeField, F, Q, Value, When
+from django.utils import timezone
+from celery import shared_task, current_app, signals
+from celery.utils import uuid
 from celery.utils.log import get_task_logger
 
+import collections
+import contextlib
 import datetime
+import threading
+
+from . import cache, events, plugins
 
 
 logger = get_task_logger(__name__)
 
+# How long, beyond any debounce, a dispatched ready_generation is
+# considered pending if it never manages to start.
+READY_PENDING_TIMEOUT = 60
+
 
 # TODO: implement signal listeners for changes to Generator, GenerationRule, and Ready
 
 
+# Each task gets its own scope for stateful plugins, as each request
+# does through PluginScopeMiddleware.
+@signals.task_prerun.connect
+def begin_plugin_scope(**kwargs):
+    plugins.begin_scope()
+
+
+@signals.task_postrun.connect
+def end_plugin_scope(**kwargs):
+    plugins.end_scope()
+
+
+@signals.worker_process_shutdown.connect
+def reset_plugins(**kwargs):
+    plugins.reset()
+
+
+def lease_duration():
+    return datetime.timedelta(
+        seconds=getattr(settings, 'TURNGENERATION_LEASE_DURATION', 600))
+
+
+def acquire_lease(pk, fence=None):
+    """
+    Try to take out the generation lease on the Generator, returning
+    the owner token on success or None if someone else holds it.  With
+    a `fence`, the lease is only taken if the Generator's task id still
+    matches it.
+
+    With `TURNGENERATION_LOCK_SKIP_LOCKED` set, on backends that
+    support it the row is locked with SELECT ... FOR UPDATE SKIP LOCKED
+    first, so that contending tasks give up rather than queue up
+    behind each other.
+
+    """
+    from . import models
+
+    token = uuid()
+    queryset = models.Generator.objects.unlocked().filter(pk=pk)
+    if fence is not None:
+        queryset = queryset.filter(task_id=fence)
+    fields = {'lock_owner': token,
+              'lock_expires': timezone.now() + lease_duration()}
+
+    # The feature flag only exists from Django 1.11.
+    if (getattr(settings, 'TURNGENERATION_LOCK_SKIP_LOCKED', False) and
+            getattr(connection.features,
+                    'has_select_for_update_skip_locked', False)):
+        with transaction.atomic():
+            locked = queryset.select_for_update(
+                skip_locked=True).values_list('pk', flat=True)
+            if not list(locked):
+                return
+            acquired = queryset.update(**fields)
+    else:
+        acquired = queryset.update(**fields)
+
+    if acquired:
+        models.state_changed(models.Generator.objects.filter(pk=pk))
+        return token
+
+
+def extend_lease(token):
+    from . import models
+
+    return bool(models.Generator.objects.filter(lock_owner=token).update(
+        lock_expires=timezone.now() + lease_duration()))
+
+
+def release_lease(pk, token, **fields):
+    """
+    Release the generation lease, along with updating any other
+    `fields`, provided that the lease has not since been lost to
+    another task.
+
+    """
+    from . import models
+
+    released = bool(models.Generator.objects.filter(
+        pk=pk, lock_owner=token).update(
+            lock_owner='', lock_expires=None, **fields))
+    if released:
+        models.state_changed(models.Generator.objects.filter(pk=pk))
+        if 'generation_time' in fields:
+            events.publish(pk, 'schedule',
+                           generation_time=fields['generation_time'])
+    return released
+
+
+@contextlib.contextmanager
+def heartbeat(token):
+    """
+    Keep extending the generation lease(s) held by `token` from a
+    background thread for as long as the block runs.
+
+    """
+    stopped = threading.Event()
+    interval = lease_duration().total_seconds() / 3
+
+    def beat():
+        try:
+            while not stopped.wait(interval):
+                if not extend_lease(token):
+                    logger.warning(
+                        "Lost generation lease {0}.".format(token))
+                    break
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def sweeper_enabled():
+    return getattr(settings, 'TURNGENERATION_SCHEDULER', 'eta') == 'sweep'
+
+
+def task_expiry():
+    """
+    How long after they are due timed tasks expire, or None if they
+    don't.  Only the sweeper reschedules a generation whose task has
+    expired, so tasks expire only with the sweeper enabled, or with
+    `TURNGENERATION_TASK_EXPIRES` set explicitly.
+
+    """
+    expires = getattr(settings, 'TURNGENERATION_TASK_EXPIRES', None)
+    if expires is None:
+        if not sweeper_enabled():
+            return
+        expires = 3600
+    return datetime.timedelta(seconds=expires)
+
+
+def task_options(eta):
+    options = {'eta': eta}
+    expiry = task_expiry()
+    if expiry is not None:
+        options['expires'] = eta + expiry
+    return options
+
+
+def schedule_timed_generation(pk, eta):
+    """
+    Return the task id to be stored on the Generator for a timed
+    generation at `eta`.  Once it has been stored, the task is queued
+    with `dispatch_timed_generation`.
+
+    The task id doubles as a fencing token: a timed generation that
+    starts up and finds that the Generator has moved on to some other
+    task id exits without doing anything.
+
+    When the sweep scheduler is enabled an empty task id is returned,
+    and `sweep_generations` will claim and dispatch the generation once
+    `eta` falls within the sweep horizon.
+
+    """
+    if eta is None or sweeper_enabled():
+        return ''
+    return uuid()
+
+
+def dispatch_timed_generation(pk, task_id, eta):
+    if not task_id:
+        return
+    timed_generation.apply_async((pk, task_id), task_id=task_id,
+                                 **task_options(eta))
+
+
+def dispatch_batch_timed_generation(pks, task_id, eta):
+    if not task_id:
+        return
+    batch_timed_generation.apply_async((pks, task_id), task_id=task_id,
+                                       **task_options(eta))
+
+
+def batches(pks):
+    size = max(getattr(settings, 'TURNGENERATION_BATCH_SIZE', 1), 1)
+    for i in range(0, len(pks), size):
+        yield pks[i:i + size]
+
+
+def too_soon(minimum, last, now):
+    """
+    Whether `minimum` seconds have yet to pass since the generation at
+    `last`.
+
+    """
+    return bool(minimum and last and
+                last + datetime.timedelta(seconds=minimum) > now)
+
+
+def revoke(task_id):
+    """
+    Broadcast a revoke for a superseded task, if enabled with
+    `TURNGENERATION_REVOKE_TASKS`.  Otherwise the fencing check or the
+    task's expiry takes care of it.
+
+    """
+    if task_id and getattr(settings, 'TURNGENERATION_REVOKE_TASKS', False):
+        current_app.control.revoke(task_id)
+
+
+def rollover(generator):
+    """
+    Record a completed generation on `generator`, and clear out the
+    agents' readies for the new turn.  Returns the time of the
+    generation, for storing as `last_generated_at` on releasing the
+    lease.
+
+    """
+    from . import models
+
+    agent_count = generator.count_agents()
+    with transaction.atomic():
+        generated_at = generator.timestamps.create().timestamp
+        generator.readies.all().delete()
+        models.Generator.objects.filter(pk=generator.pk).update(
+            ready_count=0, agent_count=agent_count)
+    return generated_at
+
+
+def expired_history(now):
+    """
+    The GenerationTime entries older than their Generator's
+    `history_retention` or, failing that, the
+    `TURNGENERATION_HISTORY_RETENTION` days.
+
+    """
+    from . import models
+
+    def cutoff(days):
+        return now - datetime.timedelta(days=days)
+
+    expired = Q()
+    default = getattr(settings, 'TURNGENERATION_HISTORY_RETENTION', None)
+    if default is not None:
+        expired |= Q(generator__history_retention__isnull=True,
+                     timestamp__lt=cutoff(default))
+
+    retentions = models.Generator.objects.filter(
+        history_retention__isnull=False
+    ).values_list('history_retention', flat=True).distinct()
+    for days in retentions:
+        expired |= Q(generator__history_retention=days,
+                     timestamp__lt=cutoff(days))
+
+    if not expired:
+        return models.GenerationTime.objects.none()
+    return models.GenerationTime.objects.filter(expired)
+
+
+def roll_up(pks):
+    """
+    Add the GenerationTime entries `pks` to the per-day GenerationCounts
+    and delete them, returning the number deleted.
+
+    """
+    from . import models
+
+    with transaction.atomic():
+        # Lock the entries first, so that entries claimed by a concurrent
+        # prune are neither counted nor deleted twice.
+        entries = models.GenerationTime.objects.select_for_update().filter(
+            pk__in=pks).values_list('pk', 'generator_id', 'timestamp')
+
+        counts = collections.Counter()
+        pks = []
+        for pk, generator_id, timestamp in entries:
+            if settings.USE_TZ:
+                timestamp = timezone.localtime(timestamp)
+            counts[generator_id, timestamp.date()] += 1
+            pks.append(pk)
+
+        for (generator_id, date), count in counts.items():
+            if not models.GenerationCount.objects.filter(
+                    generator_id=generator_id, date=date
+            ).update(count=F('count') + count):
+                models.GenerationCount.objects.create(
+                    generator_id=generator_id, date=date, count=count)
+
+        models.GenerationTime.objects.filter(pk__in=pks).delete()
+    return len(pks)
+
+
+def ready_pending_key(pk):
+    return 'turngeneration:ready-pending:{0}'.format(pk)
+
+
+def dispatch_ready_generation(pk):
+    """
+    Queue up a ready_generation for the Generator, unless one is
+    already pending.  If `TURNGENERATION_READY_DEBOUNCE` is set, the
+    task is delayed by that many seconds, to ride out agents flapping
+    between ready and unready.
+
+    """
+    debounce = getattr(settings, 'TURNGENERATION_READY_DEBOUNCE', 0)
+    if not cache.get_cache().add(ready_pending_key(pk), True,
+                                 debounce + READY_PENDING_TIMEOUT):
+        logger.debug(
+            "Auto-generation already pending for: {0}".format(pk))
+        return
+
+    if debounce:
+        ready_generation.apply_async((pk,), countdown=debounce)
+    else:
+        ready_generation.apply_async((pk,))
+
+
+@shared_task(bind=True)
+def sweep_generations(self):
+    """
+    Dispatch timed generations for every Generator whose stored
+    `generation_time` falls within the sweep horizon and which does not
+    already have a task queued.  Intended to be run periodically (e.g.
+    from celery beat) when `TURNGENERATION_SCHEDULER = 'sweep'`.
+
+    """
+    from . import models
+
+    # Reclaim the leases of tasks that died mid-generation.  Their
+    # generations are due again, so clear out the dead task ids too.
+    reclaimed = models.Generator.objects.exclude(lock_owner='').filter(
+        lock_expires__lte=timezone.now()
+    ).update(lock_owner='', lock_expires=None, task_id='')
+    if reclaimed:
+        logger.warning(
+            "Reclaimed {n} expired generation lease(s).".format(n=reclaimed))
+
+    # Tasks still queued past their expiry have been discarded by the
+    # broker, so their generations need to be dispatched afresh.
+    expiry = task_expiry()
+    if expiry is not None:
+        expired = models.Generator.objects.unlocked().exclude(
+            task_id='').filter(
+                generation_time__lt=timezone.now() - expiry
+        ).update(task_id='')
+        if expired:
+            logger.warning(
+                "Rescheduling {n} expired timed generation(s).".format(
+                    n=expired))
+
+    horizon = datetime.timedelta(
+        seconds=getattr(settings, 'TURNGENERATION_SWEEP_HORIZON', 60))
+    due = models.Generator.objects.unlocked().filter(
+        force_generate=True, task_id='',
+        generation_time__lte=timezone.now() + horizon,
+    ).values_list('pk', 'generation_time')
+
+    schedule = collections.defaultdict(list)
+    for pk, eta in due:
+        schedule[eta].append(pk)
+
+    dispatched = 0
+    for eta, pks in schedule.items():
+        for batch in batches(pks):
+            task_id = uuid()
+            # Claim the Generators before queueing, so that overlapping
+            # sweeps do not dispatch the same generations twice.
+            if not models.Generator.objects.filter(
+                    pk__in=batch, task_id='', generation_time=eta
+            ).update(task_id=task_id):
+                continue
+
+            if len(batch) == 1:
+                dispatch_timed_generation(batch[0], task_id, eta)
+                dispatched += 1
+                continue
+
+            claimed = list(models.Generator.objects.filter(
+                task_id=task_id).values_list('pk', flat=True))
+            dispatch_batch_timed_generation(claimed, task_id, eta)
+            dispatched += len(claimed)
+
+    if dispatched:
+        logger.info("Dispatched {n} timed generation(s).".format(n=dispatched))
+    return dispatched
+
+
+@shared_task(bind=True)
+def prune_generation_history(self, max_batches=None):
+    """
+    Roll up and delete the GenerationTime entries past retention, in
+    batches of `TURNGENERATION_HISTORY_BATCH_SIZE` (1000 by default),
+    each in its own transaction.  Intended to be run periodically (e.g.
+    from celery beat) or with the `prune_generation_history` command.
+
+    """
+    size = max(getattr(settings, 'TURNGENERATION_HISTORY_BATCH_SIZE', 1000), 1)
+    expired = expired_history(timezone.now()).order_by('pk')
+
+    pruned = batch_count = 0
+    while max_batches is None or batch_count < max_batches:
+        pks = list(expired.values_list('pk', flat=True)[:size])
+        if not pks:
+            break
+        pruned += roll_up(pks)
+        batch_count += 1
+
+    if pruned:
+        logger.info("Pruned {n} generation time(s).".format(n=pruned))
+    return pruned
+
+
 @shared_task(bind=True)
-def timed_generation(self, pk):
+def timed_generation(self, pk, fence=None):
     from . import models, plugins
 
     try:
@@ -23,23 +446,35 @@ def timed_generation(self, pk):
         logger.exception("Failed timed_generation(pk={pk}).".format(pk=pk))
         raise
 
+    if fence is not None and generator.task_id != fence:
+        logger.info(
+            "Timed generation superseded on {app}.{model}(pk={pk}),"
+            " aborting.".format(
+                app=realm_type.app_label, model=realm_type.model, pk=realm.pk)
+        )
+        return
+
     logger.info(
         "Beginning timed generation on {app}.{model}(pk={pk}).".format(
             app=realm_type.app_label, model=realm_type.model, pk=realm.pk)
     )
 
-    # Lock against another task generating on the same Generator.
-    if not models.Generator.objects.filter(
-            pk=pk, generating=False).update(generating=True):
+    # Lock against another task generating on the same Generator, and
+    # against this task having been superseded since the check above.
+    token = acquire_lease(pk, fence)
+    if token is None:
         logger.warning(
-            "Generation already in progress on {app}.{model}(pk={pk}),"
-            " aborting.".format(
+            "Generation already in progress or superseded on"
+            " {app}.{model}(pk={pk}), aborting.".format(
                 app=realm_type.app_label, model=realm_type.model, pk=realm.pk)
         )
         # Any update of the generator or firing of a new task should
         # be dealt with by the task holding the lock.
         return
 
+    # Another task may have generated before the lease was taken.
+    generator.refresh_from_db()
+
     if not generator.force_generate:
         logger.info(
             "Force-generation is disabled on {app}.{model}(pk={pk}),"
@@ -49,9 +484,7 @@ def timed_generation(self, pk):
         # No need to fire off a new task, since force-generations will
         # be disabled until the boolean is cleared, and then the
         # overriden save method will handle it.
-        models.Generator.objects.filter(pk=pk).update(generating=False,
-                                                      task_id='',
-                                                      generation_time=None)
+        release_lease(pk, token, task_id='', generation_time=None)
         return
 
     if generator.allow_pauses and generator.pauses.exists():
@@ -61,16 +494,14 @@ def timed_generation(self, pk):
         )
         # If the generator is paused, don't bother creating a new timed task.
         # It'll get picked back up when the pause is cancelled.
-        models.Generator.objects.filter(pk=pk).update(generating=False,
-                                                      task_id='',
-                                                      generation_time=None)
+        release_lease(pk, token, task_id='', generation_time=None)
         return
 
     generate = True
+    generated = {}
 
-    now = datetime.datetime.utcnow()
-    last = generator.last_generation
-    if last and last + generator.minimum_between_generations > now:
+    if too_soon(generator.minimum_between_generations,
+                generator.last_generated_at, timezone.now()):
         logger.info(
             "Insufficient time since last generation on {app}.{model}(pk={pk})"
             ", aborting.".format(
@@ -79,28 +510,29 @@ def timed_generation(self, pk):
         generate = False
 
     if generate:
+        events.publish(pk, 'generation', status='started')
         try:
             plugin = plugins.get_plugin_for_model(realm)
-            plugin.force_generate(realm)
+            with heartbeat(token):
+                plugin.force_generate(realm)
         except Exception as e:
             # TODO: consider doing a transaction rollback here
             logger.exception(
                 "Generation failed on {app}.{model}(pk={pk}).".format(
                     app=realm_type.app_label, model=realm_type.model, pk=realm.pk)
             )
+            events.publish(pk, 'generation', status='failed')
             generate = False
         else:
-            generator.timestamps.create()
-            generator.readies.all().delete()
+            generated['last_generated_at'] = rollover(generator)
+            events.publish(pk, 'generation', status='finished')
 
-    task_id = ''
     eta = generator.next_time()
-    if eta is not None:
-        task_id = timed_generation.apply_async((pk,), eta=eta).id
+    task_id = schedule_timed_generation(pk, eta)
 
-    models.Generator.objects.filter(pk=pk).update(generating=False,
-                                                  task_id=task_id,
-                                                  generation_time=eta)
+    if release_lease(pk, token, task_id=task_id, generation_time=eta,
+                     **generated):
+        dispatch_timed_generation(pk, task_id, eta)
 
     if generate:
         logger.info(
@@ -113,6 +545,9 @@ def timed_generation(self, pk):
 def ready_generation(self, pk):
     from . import models, plugins
 
+    # Any readies from here on should be able to dispatch a new task.
+    cache.get_cache().delete(ready_pending_key(pk))
+
     try:
         generator = models.Generator.objects.get(pk=pk)
         realm_type = generator.content_type
@@ -127,8 +562,8 @@ def ready_generation(self, pk):
     )
 
     # Lock against another task generating on the same Generator.
-    if not models.Generator.objects.filter(
-            pk=pk, generating=False).update(generating=True):
+    token = acquire_lease(pk)
+    if token is None:
         logger.warning(
             "Generation already in progress on {app}.{model}(pk={pk}),"
             " aborting.".format(
@@ -138,13 +573,31 @@ def ready_generation(self, pk):
         # be dealt with by the task holding the lock.
         return
 
+    # Another task may have generated before the lease was taken.
+    generator.refresh_from_db()
+
     if not generator.autogenerate:
         logger.info(
             "Auto-generation not permitted on {app}.{model}(pk={pk}),"
             " aborting.".format(
                 app=realm_type.app_label, model=realm_type.model, pk=realm.pk)
         )
-        models.Generator.objects.filter(pk=pk).update(generating=False)
+        release_lease(pk, token)
+        return
+
+    if too_soon(generator.minimum_between_generations,
+                generator.last_generated_at, timezone.now()):
+        logger.info(
+            "Insufficient time since last generation on {app}.{model}(pk={pk})"
+            ", delaying.".format(
+                app=realm_type.app_label, model=realm_type.model, pk=realm.pk)
+        )
+        release_lease(pk, token)
+        # Try again once the minimum has passed, in case the agents are
+        # all still ready by then.
+        ready_generation.apply_async(
+            (pk,), eta=generator.last_generated_at + datetime.timedelta(
+                seconds=generator.minimum_between_generations))
         return
 
     try:
@@ -154,34 +607,189 @@ def ready_generation(self, pk):
                 " aborting.".format(
                     app=realm_type.app_label, model=realm_type.model, pk=realm.pk)
             )
-            models.Generator.objects.filter(pk=pk).update(generating=False)
+            release_lease(pk, token)
             return
 
+        events.publish(pk, 'generation', status='started')
         plugin = plugins.get_plugin_for_model(realm)
-        plugin.auto_generate(realm)
+        with heartbeat(token):
+            plugin.auto_generate(realm)
     except Exception as e:
         # TODO: consider doing a transaction rollback here
         logger.exception(
             "Generation failed on {app}.{model}(pk={pk}).".format(
                 app=realm_type.app_label, model=realm_type.model, pk=realm.pk)
         )
-        models.Generator.objects.filter(pk=pk).update(generating=False)
+        events.publish(pk, 'generation', status='failed')
+        release_lease(pk, token)
         return
 
-    generator.timestamps.create()
-    generator.readies.all().delete()
+    generated_at = rollover(generator)
+    events.publish(pk, 'generation', status='finished')
 
     task_id, eta = '', None
     if generator.force_generate:
         eta = generator.next_time()
-        if eta is not None:
-            task_id = timed_generation.apply_async((pk,), eta=eta).id
+        task_id = schedule_timed_generation(pk, eta)
 
-    current_app.control.revoke(generator.task_id)
-    models.Generator.objects.filter(pk=pk).update(generating=False,
-                                                  task_id=task_id,
-                                                  generation_time=eta)
+    # Storing the new task id fences off the superseded timed task.
+    if release_lease(pk, token, task_id=task_id, generation_time=eta,
+                     last_generated_at=generated_at):
+        revoke(generator.task_id)
+        dispatch_timed_generation(pk, task_id, eta)
     logger.info(
         "Ending auto-generation on {app}.{model}(pk={pk}).".format(
             app=realm_type.app_label, model=realm_type.model, pk=pk)
     )
+
+
+@shared_task(bind=True)
+def batch_timed_generation(self, pks, fence=None):
+    """
+    Timed generation for many Generators that are due at the same
+    time, doing each step for all of them with bulk queries.  Plugins
+    that provide `bulk_force_generate(realms)` generate all of their
+    realms in a single call.
+
+    """
+    from . import models, plugins
+
+    logger.info(
+        "Beginning batch timed generation on {n} Generator(s).".format(
+            n=len(pks))
+    )
+
+    # Lock against other tasks generating on any of the Generators.
+    token = uuid()
+    queryset = models.Generator.objects.filter(pk__in=pks)
+    if fence is not None:
+        queryset = queryset.filter(task_id=fence)
+    queryset.unlocked().update(lock_owner=token,
+                               lock_expires=timezone.now() + lease_duration())
+
+    generators = list(models.Generator.objects.filter(
+        lock_owner=token).select_related('content_type'))
+    if len(generators) < len(pks):
+        logger.warning(
+            "Generation already in progress or superseded on {n}"
+            " Generator(s), skipping them.".format(n=len(pks) - len(generators))
+        )
+    if not generators:
+        return 0
+    models.state_changed(generators)
+
+    paused = set(models.Pause.objects.filter(
+        generator__in=generators, generator__allow_pauses=True
+    ).values_list('generator', flat=True))
+
+    # Generators with force-generation disabled or pauses in effect
+    # don't get a new task; they'll be picked back up when that
+    # changes.  Generators too soon after their last generation just
+    # get rescheduled.
+    now = timezone.now()
+    halted, waiting, due = [], [], []
+    for generator in generators:
+        if not generator.force_generate or generator.pk in paused:
+            halted.append(generator)
+        elif too_soon(generator.minimum_between_generations,
+                      generator.last_generated_at, now):
+            waiting.append(generator)
+        else:
+            due.append(generator)
+
+    if halted:
+        logger.info(
+            "Force-generation disabled or paused on {n} Generator(s),"
+            " aborting them.".format(n=len(halted))
+        )
+        models.Generator.objects.filter(
+            pk__in=[g.pk for g in halted], lock_owner=token
+        ).update(lock_owner='', lock_expires=None, task_id='',
+                 generation_time=None)
+
+    by_type = collections.defaultdict(list)
+    for generator in due:
+        by_type[generator.content_type].append(generator)
+
+    for generator in due:
+        events.publish(generator.pk, 'generation', status='started')
+
+    generated = []
+    with heartbeat(token):
+        for realm_type, group in by_type.items():
+            plugin = plugins.get_plugin(
+                '{ct.app_label}.{ct.model}'.format(ct=realm_type))
+            realms = realm_type.model_class()._default_manager.in_bulk(
+                [g.object_id for g in group])
+            group = [g for g in group if g.object_id in realms]
+
+            if hasattr(plugin, 'bulk_force_generate'):
+                try:
+                    plugin.bulk_force_generate(
+                        [realms[g.object_id] for g in group])
+                except Exception as e:
+                    logger.exception(
+                        "Generation failed on {n} {app}.{model}"
+                        " realm(s).".format(n=len(group),
+                                            app=realm_type.app_label,
+                                            model=realm_type.model)
+                    )
+                else:
+                    generated.extend(group)
+                continue
+
+            for generator in group:
+                try:
+                    plugin.force_generate(realms[generator.object_id])
+                except Exception as e:
+                    logger.exception(
+                        "Generation failed on {app}.{model}(pk={pk}).".format(
+                            app=realm_type.app_label, model=realm_type.model,
+                            pk=generator.object_id)
+                    )
+                else:
+                    generated.append(generator)
+
+    # Roll the generated ones over to the new turn.  Their agents are
+    # recounted lazily, on the next ready.
+    released = {'lock_owner': '', 'lock_expires': None}
+    if generated:
+        released['last_generated_at'] = Case(
+            When(pk__in=[g.pk for g in generated],
+                 then=Value(timezone.now())),
+            default=F('last_generated_at'),
+            output_field=DateTimeField())
+        with transaction.atomic():
+            models.GenerationTime.objects.bulk_create(
+                [models.GenerationTime(generator=g) for g in generated])
+            models.Ready.objects.filter(generator__in=generated).delete()
+            models.Generator.objects.filter(
+                pk__in=[g.pk for g in generated]
+            ).update(ready_count=0, agent_count=None)
+
+    generated_pks = set(g.pk for g in generated)
+    for generator in due:
+        events.publish(generator.pk, 'generation',
+                       status='finished' if generator.pk in generated_pks
+                       else 'failed')
+
+    schedule = collections.defaultdict(list)
+    for generator in waiting + due:
+        schedule[generator.next_time()].append(generator.pk)
+
+    for eta, pks in schedule.items():
+        for batch in batches(pks):
+            task_id = schedule_timed_generation(None, eta)
+            if models.Generator.objects.filter(
+                    pk__in=batch, lock_owner=token
+            ).update(task_id=task_id, generation_time=eta, **released):
+                dispatch_batch_timed_generation(batch, task_id, eta)
+                for pk in batch:
+                    events.publish(pk, 'schedule', generation_time=eta)
+
+    models.state_changed(generators)
+    logger.info(
+        "Ending batch timed generation, generated {n} of {total}"
+        " Generator(s).".format(n=len(generated), total=len(pks))
+    )
+    return len(generated)
@@ -0,0 +1,103 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from mock import patch
+
+from .. import models, plugins
+from sample_app.models import TestRealm, TestAgent
+from sample_app.plugins import TurnGeneration
+
+
+class TurnGenerationBackendTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='test',
+                                             password='password')
+        self.realm = TestRealm.objects.create(slug='500years')
+        self.agent = TestAgent.objects.create(realm=self.realm, slug='bob',
+                                              user=self.user)
+
+    def test_memoized(self):
+        with patch.object(TurnGeneration, '_is_player',
+                          return_value=True) as is_player:
+            self.assertTrue(self.user.has_perm('turngeneration.add_ready',
+                                               self.agent))
+            self.assertTrue(self.user.has_perm('turngeneration.add_ready',
+                                               self.agent))
+            self.assertEqual(is_player.call_count, 1)
+
+            self.assertTrue(self.user.has_perm('turngeneration.add_pause',
+                                               self.agent))
+            self.assertEqual(is_player.call_count, 2)
+
+            # A fresh user object, as on the next request, checks again.
+            user = User.objects.get(pk=self.user.pk)
+            self.assertTrue(user.has_perm('turngeneration.add_ready',
+                                          self.agent))
+            self.assertEqual(is_player.call_count, 3)
+
+    def test_unknown(self):
+        self.assertFalse(self.user.has_perm('turngeneration.add_ready'))
+        self.assertFalse(self.user.has_perm('turngeneration.add_ready',
+                                            self.user))
+        self.assertFalse(self.user.has_perm('turngeneration.add_rabbit',
+                                            self.agent))
+
+    @override_settings(TURNGENERATION_PERMISSION_CACHE_TIMEOUT=60)
+    def test_cross_request(self):
+        with patch.object(TurnGeneration, '_is_player',
+                          side_effect=lambda user, obj: obj.user == user) as is_player:
+            self.assertTrue(self.user.has_perm('turngeneration.add_ready',
+                                               self.agent))
+
+            user = User.objects.get(pk=self.user.pk)
+            self.assertTrue(user.has_perm('turngeneration.add_ready',
+                                          self.agent))
+            self.assertEqual(is_player.call_count, 1)
+
+            # Changing hands drops the cached results.
+            self.agent.user = None
+            self.agent.save()
+
+            user = User.objects.get(pk=self.user.pk)
+            self.assertFalse(user.has_perm('turngeneration.add_ready',
+                                           self.agent))
+            self.assertEqual(is_player.call_count, 2)
+
+            user = User.objects.get(pk=self.user.pk)
+            self.assertFalse(user.has_perm('turngeneration.add_ready',
+                                           self.agent))
+            self.assertEqual(is_player.call_count, 2)
+
+            plugins.permissions_changed(self.agent)
+            user = User.objects.get(pk=self.user.pk)
+            user.has_perm('turngeneration.add_ready', self.agent)
+            self.assertEqual(is_player.call_count, 3)
+
+
+class PermissionViewTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test',
+                                             password='password')
+        self.realm = TestRealm.objects.create(slug='500years')
+        self.agent = self.realm.agents.create(slug='agent1', user=self.user)
+        self.generator = models.Generator(realm=self.realm)
+        self.generator.save()
+        self.assertTrue(self.client.login(username='test', password='password'))
+
+    def test_one_check_per_request(self):
+        models.Pause.objects.create(generator=self.generator,
+                                    agent=self.agent, reason='Busy.')
+        url = reverse('pause',
+                      kwargs={'realm_alias': 'testrealm',
+                              'realm_pk': self.realm.pk,
+                              'agent_alias': 'testagent',
+                              'agent_pk': self.agent.pk})
+
+        with patch.object(TurnGeneration, '_is_player',
+                          return_value=True) as is_player:
+            response = self.client.put(url, {'reason': 'Away.'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(is_player.call_count, 1)
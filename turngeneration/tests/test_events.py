@@ -0,0 +1,117 @@
+from django.contrib.auth.models import User
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from mock import patch
+
+from .. import events, models, tasks
+from sample_app.models import TestRealm
+
+
+class LocalBrokerTestCase(TestCase):
+    def test_fan_out(self):
+        broker = events.LocalBroker()
+        first = broker.subscribe('a')
+        second = broker.subscribe('a')
+        other = broker.subscribe('b')
+
+        broker.publish('a', {'event': 'ready', 'data': {}})
+        self.assertEqual(first.get(timeout=0), {'event': 'ready', 'data': {}})
+        self.assertEqual(second.get(timeout=0), {'event': 'ready', 'data': {}})
+        self.assertIsNone(other.get(timeout=0))
+
+        first.close()
+        second.close()
+        broker.publish('a', {'event': 'ready', 'data': {}})
+        self.assertIsNone(first.get(timeout=0))
+        self.assertNotIn('a', broker.subscriptions)
+
+    def test_after_commit(self):
+        # Nothing is sent while the transaction is still open.
+        subscription = events.subscribe(1)
+        events.publish(1, 'rules')
+        self.assertIsNone(subscription.get(timeout=0))
+        subscription.close()
+
+
+class EventsTestCase(TransactionTestCase):
+    def setUp(self):
+        self.realm = TestRealm.objects.create(slug='500years')
+        self.agent = self.realm.agents.create(slug='agent1')
+        self.generator = models.Generator(realm=self.realm,
+                                          autogenerate=False)
+        self.generator.save()
+
+        self.subscription = events.subscribe(self.generator.pk)
+        self.addCleanup(self.subscription.close)
+
+    def received(self):
+        messages = []
+        message = self.subscription.get(timeout=0)
+        while message is not None:
+            messages.append(message)
+            message = self.subscription.get(timeout=0)
+        return messages
+
+    def test_ready(self):
+        ready = models.Ready.objects.create(generator=self.generator,
+                                            agent=self.agent)
+        ready.delete()
+
+        self.assertEqual(self.received(), [
+            {'event': 'ready',
+             'data': {'content_type': 'sample_app.testagent',
+                      'object_id': self.agent.pk, 'ready': True}},
+            {'event': 'ready',
+             'data': {'content_type': 'sample_app.testagent',
+                      'object_id': self.agent.pk, 'ready': False}},
+        ])
+
+    def test_pause_and_rules(self):
+        pause = models.Pause.objects.create(generator=self.generator,
+                                            agent=self.agent, reason='Away.')
+        pause.delete()
+        self.generator.rules.create(freq=2)
+
+        self.assertEqual(
+            [(m['event'], m['data'].get('paused')) for m in self.received()],
+            [('pause', True), ('pause', False), ('rules', None)]
+        )
+
+    @patch('turngeneration.tasks.dispatch_timed_generation')
+    def test_generation(self, dispatch):
+        self.generator.rules.create(freq=2)
+        self.received()
+
+        tasks.timed_generation(self.generator.pk)
+
+        messages = self.received()
+        self.assertEqual(
+            [(m['event'], m['data'].get('status')) for m in messages],
+            [('generation', 'started'), ('generation', 'finished'),
+             ('schedule', None)]
+        )
+        self.assertIsNotNone(messages[-1]['data']['generation_time'])
+
+    @override_settings(TURNGENERATION_EVENTS_TIMEOUT=0.2,
+                       TURNGENERATION_EVENTS_KEEPALIVE=0.05)
+    def test_stream(self):
+        User.objects.create_user(username='test', password='password')
+        self.assertTrue(self.client.login(username='test', password='password'))
+        url = reverse('generator_events',
+                      kwargs={'realm_alias': 'testrealm',
+                              'realm_pk': self.realm.pk})
+
+        response = self.client.get(url, HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        models.Ready.objects.create(generator=self.generator, agent=self.agent)
+
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('event: ready\ndata: {', content)
+        self.assertIn(':\n\n', content)
+
+        self.client.logout()
+        response = self.client.get(url, HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(response.content.startswith(b'event: error\n'))
@@ -1,13 +1,19 @@
+import contextlib
 import datetime
+import random
+import unittest
 
+import django
 from django.contrib.auth.models import User
+from django.db import connection
 from django.utils import timezone
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from mock import patch, call
 from dateutil import rrule
 import pytz
 
-from ..models import Generator, GenerationTime, GenerationRule, Pause, Ready
+from ..models import (Generator, GenerationTime, GenerationRule, Pause, Ready,
+                      next_occurrence)
 from sample_app.models import TestRealm, TestAgent
 
 
@@ -24,6 +30,15 @@ class GeneratorTestCase(TestCase):
         self.agent1 = self.realm.agents.create(slug='agent1')
         self.agent2 = self.realm.agents.create(slug='agent2')
 
+    @contextlib.contextmanager
+    def commit(self):
+        # TestCase never commits, so run the on_commit callbacks at the
+        # end of the block instead.
+        with patch('django.db.transaction.on_commit') as on_commit:
+            yield
+        for args, kwargs in on_commit.call_args_list:
+            args[0]()
+
     def test_is_ready(self, timed_task, ready_task):
         self.assertFalse(self.generator.is_ready())
 
@@ -39,6 +54,55 @@ class GeneratorTestCase(TestCase):
 
         self.assertTrue(self.generator.is_ready())
 
+    def test_is_ready_queries(self, timed_task, ready_task):
+        for i in range(10):
+            agent = self.realm.agents.create(slug='extra{0}'.format(i))
+            Ready(agent=agent, generator=self.generator, user=self.user).save()
+
+        generator = Generator.objects.get(pk=self.generator.pk)
+        # The realm, then the agent and ready comparisons.
+        with self.assertNumQueries(3):
+            self.assertFalse(generator.is_ready())
+
+    @unittest.skipIf(django.VERSION < (1, 11),
+                     "annotate_ready() requires Django 1.11 or later.")
+    def test_annotate_ready(self, timed_task, ready_task):
+        other_realm = TestRealm.objects.create(slug='othergame')
+        other = Generator(realm=other_realm)
+        other.save()
+        empty_realm = TestRealm.objects.create(slug='emptygame')
+        empty = Generator(realm=empty_realm)
+        empty.save()
+
+        agent3 = other_realm.agents.create(slug='agent3')
+
+        Ready(agent=self.agent1, generator=self.generator,
+              user=self.user).save()
+        Ready(agent=agent3, generator=other, user=self.user).save()
+        # A Ready for an agent that isn't in this realm doesn't count.
+        Ready(agent=self.agent2, generator=other, user=self.user).save()
+
+        with self.assertNumQueries(1):
+            generators = {
+                g.pk: g for g in Generator.objects.annotate_ready()
+            }
+
+        self.assertEqual(generators[self.generator.pk].agents_total, 2)
+        self.assertEqual(generators[self.generator.pk].agents_ready, 1)
+        self.assertFalse(generators[self.generator.pk].ready)
+
+        self.assertEqual(generators[other.pk].agents_total, 1)
+        self.assertEqual(generators[other.pk].agents_ready, 1)
+        self.assertTrue(generators[other.pk].ready)
+
+        self.assertEqual(generators[empty.pk].agents_total, 0)
+        self.assertFalse(generators[empty.pk].ready)
+
+        self.assertEqual(
+            list(Generator.objects.annotate_ready().filter(ready=True)),
+            [other]
+        )
+
     def test_enabling_autogen_when_ready(self, timed_task, ready_task):
         self.generator.autogenerate = False
         self.generator.save()
@@ -95,9 +159,6 @@ class GeneratorTestCase(TestCase):
                          [call.apply_async((self.generator.pk,))])
 
     def test_enabling_forcegen_when_no_existing_task(self, timed_task, ready_task):
-        mocktask = timed_task.apply_async.return_value
-        mocktask.id = 'fake'
-
         self.generator.rules.create(
             freq=rrule.DAILY,
             dtstart=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
@@ -109,11 +170,96 @@ class GeneratorTestCase(TestCase):
         self.assertIsNone(self.generator.generation_time)
 
         self.generator.force_generate = True
-        self.generator.save()
+        with self.commit():
+            self.generator.save()
+            # The task isn't queued until its id has been committed.
+            self.assertFalse(timed_task.mock_calls)
 
         self.assertTrue(self.generator.task_id)
         self.assertIsNotNone(self.generator.generation_time)
 
+        eta = self.generator.generation_time
+        self.assertEqual(
+            timed_task.mock_calls,
+            [call.apply_async((self.generator.pk, self.generator.task_id),
+                              task_id=self.generator.task_id, eta=eta)]
+        )
+        self.assertEqual(
+            Generator.objects.get(pk=self.generator.pk).task_id,
+            self.generator.task_id
+        )
+
+    def test_stale_save_keeps_schedule(self, timed_task, ready_task):
+        self.generator.rules.create(
+            freq=rrule.DAILY,
+            dtstart=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
+        )
+        self.generator.save()
+        stale = Generator.objects.get(pk=self.generator.pk)
+
+        # A task runs and moves the schedule on to its successor.
+        eta = stale.generation_time + datetime.timedelta(days=1)
+        Generator.objects.filter(pk=stale.pk).update(
+            task_id='successor', generation_time=eta)
+
+        stale.allow_pauses = False
+        stale.save()
+
+        generator = Generator.objects.get(pk=stale.pk)
+        self.assertFalse(generator.allow_pauses)
+        self.assertEqual(generator.task_id, 'successor')
+        self.assertEqual(generator.generation_time, eta)
+
+        # Though disabling force-generation still clears it.
+        stale.force_generate = False
+        stale.save()
+
+        generator = Generator.objects.get(pk=stale.pk)
+        self.assertFalse(generator.task_id)
+        self.assertIsNone(generator.generation_time)
+
+    @override_settings(TURNGENERATION_TASK_EXPIRES=600)
+    def test_enabling_forcegen_with_expiry(self, timed_task, ready_task):
+        self.generator.rules.create(
+            freq=rrule.DAILY,
+            dtstart=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
+        )
+        with self.commit():
+            self.generator.save()
+
+        eta = self.generator.generation_time
+        self.assertEqual(
+            timed_task.mock_calls,
+            [call.apply_async((self.generator.pk, self.generator.task_id),
+                              task_id=self.generator.task_id, eta=eta,
+                              expires=eta + datetime.timedelta(minutes=10))]
+        )
+
+    @override_settings(TURNGENERATION_SCHEDULER='sweep')
+    def test_enabling_forcegen_with_sweeper(self, timed_task, ready_task):
+        self.generator.rules.create(
+            freq=rrule.DAILY,
+            dtstart=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
+        )
+        self.generator.force_generate = False
+        self.generator.save()
+
+        self.generator.force_generate = True
+        self.generator.save()
+
+        # The sweeper will pick it up; nothing gets queued directly.
+        self.assertFalse(self.generator.task_id)
+        self.assertIsNotNone(self.generator.generation_time)
+        self.assertFalse(timed_task.mock_calls)
+
+        with patch('celery.current_app.control') as control:
+            self.generator.force_generate = False
+            self.generator.save()
+
+            self.assertFalse(control.mock_calls)
+
+        self.assertIsNone(self.generator.generation_time)
+
     def test_enabling_forcegen_when_task_exists(self, timed_task, ready_task):
         Generator.objects.filter(id=self.generator.id).update(
             force_generate=False, task_id='fake',
@@ -135,6 +281,24 @@ class GeneratorTestCase(TestCase):
             generation_time=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
         )
 
+        generator = Generator.objects.get(id=self.generator.id)
+        with patch('celery.current_app.control') as control:
+            generator.force_generate = False
+            generator.save()
+
+            # The task is fenced off by the cleared task id instead.
+            self.assertFalse(control.mock_calls)
+
+        self.assertFalse(generator.task_id)
+        self.assertIsNone(generator.generation_time)
+
+    @override_settings(TURNGENERATION_REVOKE_TASKS=True)
+    def test_disabling_forcegen_with_revoke(self, timed_task, ready_task):
+        Generator.objects.filter(id=self.generator.id).update(
+            task_id='fake',
+            generation_time=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
+        )
+
         generator = Generator.objects.get(id=self.generator.id)
         with patch('celery.current_app.control') as control:
             generator.force_generate = False
@@ -196,6 +360,114 @@ class GenerationRuleTestCase(TestCase):
         self.assertEqual(next_time,
                          datetime.datetime(2014, 12, 6, 18, tzinfo=pytz.utc))
 
+    def test_multiple(self):
+        self.generator.rules.create(
+            freq=rrule.WEEKLY,
+            dtstart=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
+        )
+        self.generator.rules.create(
+            freq=rrule.DAILY,
+            dtstart=datetime.datetime(2014, 11, 29, 6, tzinfo=pytz.utc),
+            byhour='6,12'
+        )
+
+        next_time = self.generator.next_time(self.now)
+        self.assertEqual(next_time,
+                         datetime.datetime(2014, 11, 30, 12, tzinfo=pytz.utc))
+
+    def test_minutely_from_long_ago(self):
+        self.generator.rules.create(
+            freq=rrule.MINUTELY,
+            interval=7,
+            dtstart=datetime.datetime(2012, 11, 30, 10, 3, tzinfo=pytz.utc)
+        )
+
+        next_time = self.generator.next_time(self.now)
+        self.assertEqual(next_time,
+                         datetime.datetime(2014, 11, 30, 10, 7, tzinfo=pytz.utc))
+
+    def test_exhausted(self):
+        self.generator.rules.create(
+            freq=rrule.HOURLY,
+            count=5,
+            dtstart=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
+        )
+        self.generator.rules.create(
+            freq=rrule.DAILY,
+            until=datetime.datetime(2014, 11, 30, 9, tzinfo=pytz.utc),
+            dtstart=datetime.datetime(2014, 11, 28, 9, tzinfo=pytz.utc)
+        )
+
+        self.assertIsNone(self.generator.next_time(self.now))
+
+    def test_cached(self):
+        rule = self.generator.rules.create(
+            freq=rrule.DAILY,
+            dtstart=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
+        )
+        self.generator.next_time(self.now)
+
+        with self.assertNumQueries(0):
+            next_time = self.generator.next_time(self.now)
+        self.assertEqual(next_time,
+                         datetime.datetime(2014, 11, 30, 18, tzinfo=pytz.utc))
+
+        rule.freq = rrule.WEEKLY
+        rule.save()
+
+        next_time = self.generator.next_time(self.now)
+        self.assertEqual(next_time,
+                         datetime.datetime(2014, 12, 6, 18, tzinfo=pytz.utc))
+
+        rule.delete()
+
+        self.assertIsNone(self.generator.next_time(self.now))
+
+
+class NextOccurrenceTestCase(TestCase):
+    def test_agrees_with_dateutil(self):
+        rng = random.Random(1729)
+        periods = {rrule.WEEKLY: 7 * 24 * 60 * 60, rrule.DAILY: 24 * 60 * 60,
+                   rrule.HOURLY: 60 * 60, rrule.MINUTELY: 60}
+
+        for i in range(1000):
+            freq = rng.choice(sorted(periods))
+            dtstart = datetime.datetime(2010, 1, 1) + datetime.timedelta(
+                seconds=rng.randint(0, 5 * 365 * 24 * 60 * 60),
+                microseconds=rng.choice([0, rng.randint(0, 999999)]))
+            kwargs = {'dtstart': dtstart}
+            if rng.random() < 0.7:
+                kwargs['interval'] = rng.randint(1, 50)
+
+            # Keep the offsets to a few hundred occurrences, so that
+            # dateutil doesn't take forever to iterate up to them.
+            step = periods[freq] * kwargs.get('interval', 1)
+
+            def offset(low, high):
+                return dtstart + datetime.timedelta(
+                    seconds=rng.randint(low * step, high * step),
+                    microseconds=rng.choice([0, rng.randint(0, 999999)]))
+
+            if rng.random() < 0.3:
+                kwargs['count'] = rng.randint(1, 300)
+            if rng.random() < 0.3:
+                kwargs['until'] = offset(-2, 300)
+
+            cutoff = rng.choice([
+                offset(-3, 300),
+                dtstart,
+                dtstart - datetime.timedelta(microseconds=1),
+                dtstart + datetime.timedelta(microseconds=1),
+                dtstart.replace(microsecond=0) + datetime.timedelta(
+                    seconds=step * rng.randint(0, 300)),
+            ])
+
+            self.assertEqual(
+                next_occurrence(freq, kwargs, cutoff),
+                rrule.rrule(freq, **kwargs).after(cutoff),
+                "freq={0} kwargs={1} cutoff={2}".format(freq, kwargs, cutoff)
+            )
+
 
 @patch('turngeneration.tasks.ready_generation')
 @patch('turngeneration.tasks.timed_generation')
@@ -230,6 +502,80 @@ class ReadyTestCase(TestCase):
         self.assertEqual(ready_task.mock_calls,
                          [call.apply_async((self.generator.pk,))])
 
+    def test_autogenerate_dispatched_once(self, timed_task, ready_task):
+        Ready(agent=self.agent1,
+              generator=self.generator,
+              user=self.user).save()
+        Ready(agent=self.agent2,
+              generator=self.generator,
+              user=self.user).save()
+
+        # Still ready, but a ready_generation is already pending.
+        self.generator.save()
+        self.agent1.save()
+
+        self.assertEqual(ready_task.mock_calls,
+                         [call.apply_async((self.generator.pk,))])
+
+    @override_settings(TURNGENERATION_READY_DEBOUNCE=30)
+    def test_autogenerate_debounced(self, timed_task, ready_task):
+        Ready(agent=self.agent1,
+              generator=self.generator,
+              user=self.user).save()
+        Ready(agent=self.agent2,
+              generator=self.generator,
+              user=self.user).save()
+
+        self.assertEqual(ready_task.mock_calls,
+                         [call.apply_async((self.generator.pk,), countdown=30)])
+
+    def test_counters(self, timed_task, ready_task):
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertEqual(generator.agent_count, 2)
+        self.assertEqual(generator.ready_count, 0)
+
+        ready = Ready(agent=self.agent1, generator=self.generator,
+                      user=self.user)
+        ready.save()
+        # Re-saving an existing Ready doesn't count it twice.
+        ready.save()
+
+        # Nor does saving a stale Generator clobber the counters.
+        self.generator.allow_pauses = False
+        self.generator.save()
+
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertEqual(generator.ready_count, 1)
+        self.assertFalse(generator.allow_pauses)
+
+        ready.delete()
+
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertEqual(generator.ready_count, 0)
+        self.assertFalse(ready_task.mock_calls)
+
+    def test_autogenerate_when_unready_agent_leaves(self, timed_task, ready_task):
+        Ready(agent=self.agent1,
+              generator=self.generator,
+              user=self.user).save()
+        self.assertFalse(ready_task.mock_calls)
+
+        self.agent2.delete()
+
+        self.assertEqual(Generator.objects.get(pk=self.generator.pk).agent_count, 1)
+        self.assertEqual(ready_task.mock_calls,
+                         [call.apply_async((self.generator.pk,))])
+
+    def test_uncounted_agents(self, timed_task, ready_task):
+        Generator.objects.filter(pk=self.generator.pk).update(agent_count=None)
+
+        Ready(agent=self.agent1,
+              generator=self.generator,
+              user=self.user).save()
+
+        self.assertEqual(Generator.objects.get(pk=self.generator.pk).agent_count, 2)
+        self.assertFalse(ready_task.mock_calls)
+
     def test_no_autogenerate_when_ready_and_disabled(self, timed_task, ready_task):
         self.generator.autogenerate = False
         self.generator.save()
@@ -305,3 +651,73 @@ class ReadyTestCase(TestCase):
 
         self.assertFalse(timed_task.mock_calls)
         self.assertFalse(ready_task.mock_calls)
+
+
+class QueryPlanTestCase(TestCase):
+    """
+    Check that the hot queries of the sweeper and the generation tasks
+    are answered from indexes, whatever the size of the tables.
+
+    """
+    def explain(self, queryset, prefix):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return '\n'.join(' '.join(str(c) for c in row)
+                             for row in cursor.fetchall())
+
+    def due(self):
+        return Generator.objects.filter(
+            force_generate=True, task_id='',
+            generation_time__lte=timezone.now()
+        ).values_list('pk', 'generation_time')
+
+    def latest(self):
+        # As run by Generator.last_generation.
+        return Generator(pk=1).timestamps.order_by('-timestamp')[:1]
+
+    def by_generator(self):
+        return [Ready.objects.filter(generator=1),
+                Pause.objects.filter(generator=1)]
+
+    def index_name(self, table, columns):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+        for name, info in constraints.items():
+            if info['index'] and info['columns'] == columns:
+                return name
+
+    def expected_indexes(self):
+        return [
+            (self.due(), 'turngeneration_generator_due'
+             if connection.vendor == 'postgresql' else
+             self.index_name('turngeneration_generator', ['generation_time'])),
+            (self.latest(),
+             self.index_name('turngeneration_generationtime',
+                             ['generator_id', 'timestamp'])),
+        ] + [
+            (queryset, self.index_name(queryset.model._meta.db_table,
+                                       ['generator_id']))
+            for queryset in self.by_generator()
+        ]
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', "SQLite only.")
+    def test_sqlite(self):
+        for queryset, index in self.expected_indexes():
+            self.assertIsNotNone(index)
+            plan = self.explain(queryset, 'EXPLAIN QUERY PLAN ')
+            self.assertIn('INDEX {0} ('.format(index), plan)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql',
+                         "PostgreSQL only.")
+    def test_postgresql(self):
+        # The tables are empty, so sequential scans must be ruled out
+        # for the planner to consider the indexes at all.
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+        for queryset, index in self.expected_indexes():
+            self.assertIsNotNone(index)
+            plan = self.explain(queryset, 'EXPLAIN ')
+            # Either an Index Scan using it, or a Bitmap Index Scan on it.
+            self.assertIn(' {0} '.format(index), plan + ' ')
@@ -0,0 +1,115 @@
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from mock import patch
+
+from .. import plugins
+from sample_app.plugins import TurnGeneration
+
+
+class PluginRegistryTestCase(TestCase):
+    def setUp(self):
+        patcher = patch.multiple(plugins, _realm_types={}, _agent_types={},
+                                 _plugins={}, _populated=False,
+                                 _instances={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lazy(self):
+        self.assertFalse(plugins._populated)
+
+        with patch.object(plugins, 'iter_entry_points',
+                          wraps=plugins.iter_entry_points) as iter_entry_points:
+            with self.assertNumQueries(0):
+                plugins.get_plugin('sample_app.testrealm')
+                plugins.get_plugin('sample_app.testagent')
+
+        self.assertEqual(iter_entry_points.call_count, 1)
+        self.assertTrue(plugins._populated)
+
+    def test_types(self):
+        realm_type = plugins.realm_type('testrealm')
+        self.assertEqual(realm_type.app_label, 'sample_app')
+        self.assertEqual(realm_type.model, 'testrealm')
+
+        agent_type = plugins.agent_type('testagent')
+        self.assertEqual(agent_type.model, 'testagent')
+
+        self.assertIsNone(plugins.realm_type('starsweb'))
+        self.assertIsNone(plugins.agent_type('testrealm'))
+        self.assertEqual(plugins.all_realm_types(), [realm_type])
+
+        self.assertIsInstance(plugins.get_plugin('sample_app.testrealm'),
+                              TurnGeneration)
+
+    @override_settings(TURNGENERATION_OVERRIDES={
+        'sample_app': {'realm_types': {'testrealm': None,
+                                       'game': 'sample_app.testrealm'}}
+    })
+    def test_overrides(self):
+        self.assertIsNone(plugins.realm_type('testrealm'))
+        self.assertEqual(plugins.realm_type('game').model, 'testrealm')
+
+
+class Lifecycle(object):
+    def __init__(self):
+        self.events = ['init']
+
+    def setup(self):
+        self.events.append('setup')
+
+    def teardown(self):
+        self.events.append('teardown')
+
+
+class Stateful(Lifecycle):
+    stateful = True
+
+
+@patch.multiple(plugins, _plugins={'app.shared': Lifecycle,
+                                   'app.stateful': Stateful},
+                _populated=True, _instances={})
+class PluginLifecycleTestCase(TestCase):
+    def test_singleton(self):
+        plugin = plugins.get_plugin('app.shared')
+        self.assertIs(plugins.get_plugin('app.shared'), plugin)
+        self.assertEqual(plugin.events, ['init', 'setup'])
+
+        with plugins.plugin_scope():
+            self.assertIs(plugins.get_plugin('app.shared'), plugin)
+        self.assertEqual(plugin.events, ['init', 'setup'])
+
+        plugins.reset()
+        self.assertEqual(plugin.events, ['init', 'setup', 'teardown'])
+        self.assertIsNot(plugins.get_plugin('app.shared'), plugin)
+
+    def test_stateful(self):
+        with plugins.plugin_scope():
+            plugin = plugins.get_plugin('app.stateful')
+            with plugins.plugin_scope():
+                self.assertIs(plugins.get_plugin('app.stateful'), plugin)
+            self.assertEqual(plugin.events, ['init', 'setup'])
+        self.assertEqual(plugin.events, ['init', 'setup', 'teardown'])
+
+        with plugins.plugin_scope():
+            self.assertIsNot(plugins.get_plugin('app.stateful'), plugin)
+
+        with self.assertRaises(RuntimeError):
+            plugins.get_plugin('app.stateful')
+
+    def test_middleware(self):
+        from ..middleware import PluginScopeMiddleware
+
+        seen = []
+
+        def view(request):
+            seen.append(plugins.get_plugin('app.stateful'))
+            seen.append(plugins.get_plugin('app.stateful'))
+            return HttpResponse()
+
+        middleware = PluginScopeMiddleware(view)
+        middleware(RequestFactory().get('/'))
+        middleware(RequestFactory().get('/'))
+
+        self.assertIs(seen[0], seen[1])
+        self.assertIsNot(seen[1], seen[2])
+        self.assertEqual(seen[0].events, ['init', 'setup', 'teardown'])
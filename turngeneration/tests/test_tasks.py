@@ -1,8 +1,21 @@
-from django.test import TestCase
+import datetime
+import time
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
 from mock import patch
 
+from dateutil import rrule
+import pytz
+
 from sample_app.models import TestRealm
-from ..models import Generator, GenerationTime, Ready, Pause
+from ..models import (Generator, GenerationTime, GenerationCount, Ready,
+                      Pause)
 
 
 class TimedGenerationTestCase(TestCase):
@@ -25,6 +38,46 @@ class TimedGenerationTestCase(TestCase):
         self.assertEqual(result.status, 'SUCCESS')
         self.assertEqual(GenerationTime.objects.count(), 1)
 
+    @patch('turngeneration.tasks.ready_generation')
+    def test_rollover(self, ready_task):
+        agent1 = self.realm.agents.create(slug='agent1')
+        self.realm.agents.create(slug='agent2')
+        Ready(agent=agent1, generator=self.generator).save()
+        self.assertEqual(
+            Generator.objects.get(pk=self.generator.pk).ready_count, 1)
+
+        self.timed_generation.apply((self.generator.pk,), throw=True)
+
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertEqual(generator.ready_count, 0)
+        self.assertEqual(generator.agent_count, 2)
+        self.assertFalse(Ready.objects.exists())
+
+    def test_minimum_between_generations(self):
+        Generator.objects.filter(pk=self.generator.pk).update(
+            minimum_between_generations=3600)
+
+        self.timed_generation.apply((self.generator.pk,), throw=True)
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertEqual(generator.last_generated_at,
+                         GenerationTime.objects.get().timestamp)
+
+        # Too soon for another, which is decided without looking at the
+        # generation history.
+        with CaptureQueriesContext(connection) as queries:
+            self.timed_generation.apply((self.generator.pk,), throw=True)
+        self.assertEqual(GenerationTime.objects.count(), 1)
+        self.assertFalse([q for q in queries.captured_queries
+                          if 'turngeneration_generationtime' in q['sql']])
+        self.assertEqual(
+            Generator.objects.get(pk=self.generator.pk).last_generated_at,
+            generator.last_generated_at)
+
+        Generator.objects.filter(pk=self.generator.pk).update(
+            last_generated_at=timezone.now() - datetime.timedelta(hours=2))
+        self.timed_generation.apply((self.generator.pk,), throw=True)
+        self.assertEqual(GenerationTime.objects.count(), 2)
+
 
 class ReadyGenerationTestCase(TestCase):
     def setUp(self):
@@ -49,6 +102,462 @@ class ReadyGenerationTestCase(TestCase):
         self.assertEqual(result.status, 'SUCCESS')
         self.assertEqual(GenerationTime.objects.count(), 1)
 
+    @patch.object(Generator, 'is_ready', autospec=True)
+    def test_minimum_between_generations(self, is_ready):
+        is_ready.return_value = True
+        last = timezone.now() - datetime.timedelta(minutes=10)
+        Generator.objects.filter(pk=self.generator.pk).update(
+            minimum_between_generations=3600, last_generated_at=last)
+
+        with patch.object(self.ready_generation, 'apply_async') as apply_async:
+            self.ready_generation.apply((self.generator.pk,), throw=True)
+        self.assertFalse(GenerationTime.objects.exists())
+        self.assertEqual(apply_async.call_args[1]['eta'],
+                         last + datetime.timedelta(hours=1))
+
+        Generator.objects.filter(pk=self.generator.pk).update(
+            last_generated_at=last - datetime.timedelta(hours=1))
+        self.ready_generation.apply((self.generator.pk,), throw=True)
+        self.assertEqual(GenerationTime.objects.count(), 1)
+        self.assertGreater(
+            Generator.objects.get(pk=self.generator.pk).last_generated_at,
+            last)
+
+    def test_releases_pending(self):
+        from .. import tasks
+
+        with patch.object(tasks.ready_generation, 'apply_async') as apply_async:
+            tasks.dispatch_ready_generation(self.generator.pk)
+            tasks.dispatch_ready_generation(self.generator.pk)
+            self.assertEqual(apply_async.call_count, 1)
+
+            self.ready_generation.apply((self.generator.pk,), throw=True)
+
+            tasks.dispatch_ready_generation(self.generator.pk)
+            self.assertEqual(apply_async.call_count, 2)
+
+
+class LeaseTestCase(TestCase):
+    def setUp(self):
+        from .. import tasks
+
+        self.tasks = tasks
+        self.timed_generation = tasks.timed_generation
+
+        self.realm = TestRealm.objects.create()
+        self.generator = Generator(realm=self.realm)
+        self.generator.save()
+
+    def test_acquire_and_release(self):
+        token = self.tasks.acquire_lease(self.generator.pk)
+        self.assertTrue(token)
+        self.assertTrue(Generator.objects.get(pk=self.generator.pk).generating)
+
+        self.assertIsNone(self.tasks.acquire_lease(self.generator.pk))
+        self.assertFalse(self.tasks.release_lease(self.generator.pk, 'other'))
+        self.assertTrue(self.tasks.extend_lease(token))
+
+        self.assertTrue(self.tasks.release_lease(self.generator.pk, token))
+        self.assertFalse(Generator.objects.get(pk=self.generator.pk).generating)
+        self.assertTrue(self.tasks.acquire_lease(self.generator.pk))
+
+    @override_settings(TURNGENERATION_LOCK_SKIP_LOCKED=True)
+    def test_acquire_skip_locked(self):
+        self.assertTrue(self.tasks.acquire_lease(self.generator.pk))
+        self.assertIsNone(self.tasks.acquire_lease(self.generator.pk))
+
+    def test_live_lease_blocks_generation(self):
+        self.tasks.acquire_lease(self.generator.pk)
+
+        self.timed_generation.apply((self.generator.pk,), throw=True)
+        self.assertEqual(GenerationTime.objects.count(), 0)
+
+    def test_expired_lease_is_reclaimed(self):
+        Generator.objects.filter(pk=self.generator.pk).update(
+            lock_owner='dead', lock_expires=timezone.now())
+
+        self.timed_generation.apply((self.generator.pk,), throw=True)
+        self.assertEqual(GenerationTime.objects.count(), 1)
+
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertFalse(generator.lock_owner)
+        self.assertIsNone(generator.lock_expires)
+
+    def test_heartbeat(self):
+        token = self.tasks.acquire_lease(self.generator.pk)
+
+        with patch.object(self.tasks, 'lease_duration',
+                          return_value=datetime.timedelta(seconds=0.03)):
+            with patch.object(self.tasks, 'extend_lease',
+                              return_value=True) as extend_lease:
+                with self.tasks.heartbeat(token):
+                    time.sleep(0.1)
+
+        self.assertTrue(extend_lease.called)
+        extend_lease.assert_called_with(token)
+
+
+class FencingTestCase(TestCase):
+    def setUp(self):
+        from .. import tasks
+
+        self.timed_generation = tasks.timed_generation
+
+        self.realm = TestRealm.objects.create()
+        self.generator = Generator(realm=self.realm)
+        self.generator.save()
+        Generator.objects.filter(pk=self.generator.pk).update(task_id='current')
+
+    def test_current(self):
+        self.timed_generation.apply((self.generator.pk, 'current'), throw=True)
+        self.assertEqual(GenerationTime.objects.count(), 1)
+
+    def test_superseded(self):
+        self.timed_generation.apply((self.generator.pk, 'stale'), throw=True)
+        self.assertEqual(GenerationTime.objects.count(), 0)
+
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertEqual(generator.task_id, 'current')
+        self.assertFalse(generator.lock_owner)
+
+    def test_superseded_before_lease(self):
+        from .. import tasks
+
+        acquire_lease = tasks.acquire_lease
+
+        # Another task generates and releases its lease after this one
+        # has loaded the Generator, but before it takes the lease.
+        def generated_meanwhile(pk, fence=None):
+            Generator.objects.filter(pk=pk).update(
+                task_id='next', last_generated_at=timezone.now())
+            return acquire_lease(pk, fence)
+
+        with patch.object(tasks, 'acquire_lease',
+                          side_effect=generated_meanwhile):
+            self.timed_generation.apply((self.generator.pk, 'current'),
+                                        throw=True)
+        self.assertEqual(GenerationTime.objects.count(), 0)
+
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertEqual(generator.task_id, 'next')
+        self.assertFalse(generator.lock_owner)
+
+    def test_fresh_checks_after_lease(self):
+        from .. import tasks
+
+        acquire_lease = tasks.acquire_lease
+        Generator.objects.filter(pk=self.generator.pk).update(
+            minimum_between_generations=3600)
+
+        def generated_meanwhile(pk, fence=None):
+            Generator.objects.filter(pk=pk).update(
+                last_generated_at=timezone.now())
+            return acquire_lease(pk, fence)
+
+        with patch.object(tasks, 'acquire_lease',
+                          side_effect=generated_meanwhile):
+            self.timed_generation.apply((self.generator.pk, 'current'),
+                                        throw=True)
+        self.assertEqual(GenerationTime.objects.count(), 0)
+
+
+@override_settings(TURNGENERATION_BATCH_SIZE=10)
+@patch('turngeneration.tasks.batch_timed_generation.apply_async')
+class BatchTimedGenerationTestCase(TestCase):
+    def setUp(self):
+        from .. import tasks
+
+        self.batch_timed_generation = tasks.batch_timed_generation
+
+        self.generators = []
+        for i in range(3):
+            realm = TestRealm.objects.create()
+            realm.agents.create(slug='agent')
+            generator = Generator(realm=realm, autogenerate=False)
+            generator.save()
+            self.generators.append(generator)
+
+    def pks(self):
+        return [g.pk for g in self.generators]
+
+    def test_simple(self, apply_async):
+        agent = self.generators[0].realm.agents.get()
+        Ready(agent=agent, generator=self.generators[0]).save()
+
+        result = self.batch_timed_generation.apply((self.pks(),), throw=True)
+        self.assertEqual(result.result, 3)
+
+        self.assertEqual(GenerationTime.objects.count(), 3)
+        self.assertFalse(Ready.objects.exists())
+        for generator in Generator.objects.all():
+            self.assertFalse(generator.lock_owner)
+            self.assertEqual(generator.ready_count, 0)
+
+    def test_halted(self, apply_async):
+        paused, disabled, _ = self.generators
+        Pause(agent=paused.realm.agents.get(), generator=paused,
+              reason="vacation").save()
+        Generator.objects.filter(pk=disabled.pk).update(force_generate=False)
+
+        result = self.batch_timed_generation.apply((self.pks(),), throw=True)
+        self.assertEqual(result.result, 1)
+        self.assertEqual(GenerationTime.objects.count(), 1)
+
+    def test_minimum_between_generations(self, apply_async):
+        recent, _, _ = self.generators
+        last = timezone.now() - datetime.timedelta(minutes=10)
+        Generator.objects.filter(pk=recent.pk).update(
+            minimum_between_generations=3600, last_generated_at=last)
+
+        result = self.batch_timed_generation.apply((self.pks(),), throw=True)
+        self.assertEqual(result.result, 2)
+        self.assertFalse(GenerationTime.objects.filter(generator=recent).exists())
+
+        generators = Generator.objects.in_bulk(self.pks())
+        self.assertEqual(generators[recent.pk].last_generated_at, last)
+        for generator in self.generators[1:]:
+            self.assertGreater(generators[generator.pk].last_generated_at, last)
+
+    def test_fenced(self, apply_async):
+        Generator.objects.filter(pk__in=self.pks()[:2]).update(task_id='batch')
+
+        result = self.batch_timed_generation.apply((self.pks(), 'batch'),
+                                                   throw=True)
+        self.assertEqual(result.result, 2)
+
+    def test_bulk_hook(self, apply_async):
+        from sample_app.plugins import TurnGeneration
+
+        with patch.object(TurnGeneration, 'bulk_force_generate',
+                          create=True) as bulk_force_generate:
+            with patch.object(TurnGeneration, 'force_generate') as force_generate:
+                self.batch_timed_generation.apply((self.pks(),), throw=True)
+
+        self.assertEqual(bulk_force_generate.call_count, 1)
+        realms, = bulk_force_generate.call_args[0]
+        self.assertEqual(sorted(r.pk for r in realms),
+                         sorted(g.object_id for g in self.generators))
+        self.assertFalse(force_generate.called)
+        self.assertEqual(GenerationTime.objects.count(), 3)
+
+    def test_constant_queries(self, apply_async):
+        from sample_app.plugins import TurnGeneration
+
+        # Warm up the cached rules, as in the steady state.
+        for generator in self.generators:
+            generator.next_time()
+
+        def count_queries(pks):
+            with patch.object(TurnGeneration, 'bulk_force_generate',
+                              create=True):
+                with CaptureQueriesContext(connection) as queries:
+                    self.batch_timed_generation.apply((pks,), throw=True)
+            return len(queries)
+
+        self.assertEqual(count_queries(self.pks()[:1]),
+                         count_queries(self.pks()[1:]))
+
+    def test_reschedules_together(self, apply_async):
+        for generator in self.generators:
+            generator.rules.create(
+                freq=rrule.DAILY,
+                dtstart=datetime.datetime(2014, 11, 29, 18, tzinfo=pytz.utc)
+            )
+
+        self.batch_timed_generation.apply((self.pks(),), throw=True)
+
+        self.assertEqual(apply_async.call_count, 1)
+        (pks, task_id), = apply_async.call_args[0]
+        self.assertEqual(sorted(pks), sorted(self.pks()))
+        self.assertEqual(
+            set(Generator.objects.values_list('task_id', flat=True)),
+            {task_id}
+        )
+
+
+@override_settings(TURNGENERATION_SCHEDULER='sweep')
+@patch('turngeneration.tasks.timed_generation')
+class SweepGenerationsTestCase(TestCase):
+    def setUp(self):
+        from .. import tasks
+
+        self.sweep_generations = tasks.sweep_generations
+
+        self.realm = TestRealm.objects.create()
+        self.generator = Generator(realm=self.realm)
+        self.generator.save()
+
+    def test_dispatches_due(self, timed_task):
+        eta = timezone.now() + datetime.timedelta(seconds=30)
+        Generator.objects.filter(pk=self.generator.pk).update(
+            generation_time=eta)
+
+        result = self.sweep_generations.apply(throw=True)
+        self.assertEqual(result.result, 1)
+
+        self.assertEqual(timed_task.apply_async.call_count, 1)
+        args, kwargs = timed_task.apply_async.call_args
+        self.assertEqual(args, ((self.generator.pk, kwargs['task_id']),))
+        self.assertEqual(kwargs['eta'], eta)
+
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertEqual(generator.task_id, kwargs['task_id'])
+
+        # The Generator is now claimed, so a second sweep is a no-op.
+        result = self.sweep_generations.apply(throw=True)
+        self.assertEqual(result.result, 0)
+        self.assertEqual(timed_task.apply_async.call_count, 1)
+
+    def test_skips_beyond_horizon(self, timed_task):
+        Generator.objects.filter(pk=self.generator.pk).update(
+            generation_time=timezone.now() + datetime.timedelta(hours=1))
+
+        result = self.sweep_generations.apply(throw=True)
+        self.assertEqual(result.result, 0)
+        self.assertFalse(timed_task.mock_calls)
+
+    def test_reclaims_expired_lease(self, timed_task):
+        Generator.objects.filter(pk=self.generator.pk).update(
+            generation_time=timezone.now(), task_id='dead',
+            lock_owner='dead', lock_expires=timezone.now())
+
+        result = self.sweep_generations.apply(throw=True)
+        self.assertEqual(result.result, 1)
+
+        generator = Generator.objects.get(pk=self.generator.pk)
+        self.assertFalse(generator.lock_owner)
+        self.assertNotEqual(generator.task_id, 'dead')
+
+    def test_reschedules_expired_task(self, timed_task):
+        Generator.objects.filter(pk=self.generator.pk).update(
+            generation_time=timezone.now() - datetime.timedelta(hours=2),
+            task_id='expired')
+
+        result = self.sweep_generations.apply(throw=True)
+        self.assertEqual(result.result, 1)
+        self.assertNotEqual(
+            Generator.objects.get(pk=self.generator.pk).task_id, 'expired')
+
+    @override_settings(TURNGENERATION_BATCH_SIZE=10)
+    @patch('turngeneration.tasks.batch_timed_generation.apply_async')
+    def test_dispatches_batches(self, apply_async, timed_task):
+        eta = timezone.now()
+        others = [Generator(realm=TestRealm.objects.create()) for i in range(2)]
+        for generator in others:
+            generator.save()
+        Generator.objects.update(generation_time=eta)
+
+        result = self.sweep_generations.apply(throw=True)
+        self.assertEqual(result.result, 3)
+        self.assertFalse(timed_task.mock_calls)
+
+        self.assertEqual(apply_async.call_count, 1)
+        (pks, task_id), = apply_async.call_args[0]
+        self.assertEqual(len(pks), 3)
+        self.assertEqual(
+            set(Generator.objects.values_list('task_id', flat=True)),
+            {task_id}
+        )
+
+    def test_skips_disabled(self, timed_task):
+        Generator.objects.filter(pk=self.generator.pk).update(
+            generation_time=timezone.now(), force_generate=False)
+
+        result = self.sweep_generations.apply(throw=True)
+        self.assertEqual(result.result, 0)
+        self.assertFalse(timed_task.mock_calls)
+
+
+class PruneGenerationHistoryTestCase(TestCase):
+    def setUp(self):
+        from .. import tasks
+
+        self.prune_generation_history = tasks.prune_generation_history
+
+        self.realm = TestRealm.objects.create()
+        self.generator = Generator(realm=self.realm, autogenerate=False)
+        self.generator.save()
+
+        self.now = timezone.now()
+
+    def add_history(self, generator, *days_ago):
+        for days in days_ago:
+            entry = generator.timestamps.create()
+            GenerationTime.objects.filter(pk=entry.pk).update(
+                timestamp=self.now - datetime.timedelta(days=days))
+
+    def test_keeps_everything_by_default(self):
+        self.add_history(self.generator, 100, 1)
+
+        result = self.prune_generation_history.apply(throw=True)
+        self.assertEqual(result.result, 0)
+        self.assertEqual(GenerationTime.objects.count(), 2)
+
+    @override_settings(TURNGENERATION_HISTORY_RETENTION=30)
+    def test_rolls_up(self):
+        self.add_history(self.generator, 100, 100, 40, 1)
+
+        result = self.prune_generation_history.apply(throw=True)
+        self.assertEqual(result.result, 3)
+        self.assertEqual(GenerationTime.objects.count(), 1)
+
+        self.assertEqual(
+            sorted(GenerationCount.objects.values_list('date', 'count')),
+            [((self.now - datetime.timedelta(days=100)).date(), 2),
+             ((self.now - datetime.timedelta(days=40)).date(), 1)]
+        )
+
+        # Entries pruned later add to the existing counts.
+        self.add_history(self.generator, 100)
+        self.prune_generation_history.apply(throw=True)
+        self.assertEqual(
+            GenerationCount.objects.aggregate(Sum('count'))['count__sum'], 4)
+
+    @override_settings(TURNGENERATION_HISTORY_RETENTION=30)
+    def test_per_generator(self):
+        other = Generator(realm=TestRealm.objects.create(),
+                          autogenerate=False, history_retention=7)
+        other.save()
+        self.add_history(self.generator, 10)
+        self.add_history(other, 10)
+
+        result = self.prune_generation_history.apply(throw=True)
+        self.assertEqual(result.result, 1)
+        self.assertEqual(
+            list(GenerationTime.objects.values_list('generator', flat=True)),
+            [self.generator.pk]
+        )
+
+    @override_settings(TURNGENERATION_HISTORY_RETENTION=30,
+                       TURNGENERATION_HISTORY_BATCH_SIZE=2)
+    def test_batches(self):
+        self.add_history(self.generator, 40, 40, 40, 40, 40)
+
+        result = self.prune_generation_history.apply(
+            kwargs={'max_batches': 2}, throw=True)
+        self.assertEqual(result.result, 4)
+        self.assertEqual(GenerationTime.objects.count(), 1)
+
+        out = StringIO()
+        call_command('prune_generation_history', stdout=out)
+        self.assertEqual(out.getvalue(), "Pruned 1 generation time(s).\n")
+        self.assertEqual(GenerationTime.objects.count(), 0)
+        self.assertEqual(GenerationCount.objects.get().count, 5)
+
+
+class SharedCacheCheckTestCase(TestCase):
+    def test_local_memory(self):
+        from ..cache import check_shared_cache
+
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            errors = check_shared_cache(None)
+        self.assertEqual([e.id for e in errors], ['turngeneration.W001'])
+
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
 
 class IntegrationTestCase(TestCase):
     def setUp(self):
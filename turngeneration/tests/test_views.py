@@ -1,13 +1,46 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User
+from rest_framework.response import Response
 from rest_framework.test import APITestCase
 from mock import patch, call
 
-from .. import models
+import time
+
+from .. import models, views
 from sample_app.models import TestRealm, TestAgent
+from sample_app.plugins import TurnGeneration
+
+
+class ConstantQueriesMixin(object):
+    def assertConstantQueries(self, request, add_rows):
+        """
+        Assert that `request()` runs as many queries once `add_rows()`
+        has added to the tables as it did before, returning its final
+        response.
+
+        """
+        def count_queries():
+            with CaptureQueriesContext(connection) as context:
+                response = request()
+            self.assertEqual(response.status_code, 200)
+            return len(context.captured_queries), response
+
+        # Warm the caches, such as the ContentType cache, first.
+        count_queries()
+        baseline, _ = count_queries()
+
+        add_rows()
+        queries, response = count_queries()
+        self.assertEqual(queries, baseline)
+        return response
 
 
-class RealmListViewTestCase(APITestCase):
+class RealmListViewTestCase(ConstantQueriesMixin, APITestCase):
     def setUp(self):
         self.user = User.objects.create_user(username='test',
                                              password='password')
@@ -30,7 +63,67 @@ class RealmListViewTestCase(APITestCase):
 
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_constant_queries(self):
+        url = reverse('realm_list',
+                      kwargs={'realm_alias': 'testrealm'})
+
+        realms = []
+
+        def add_realms():
+            for i in range(5):
+                realm = TestRealm.objects.create(slug='realm{0}'.format(i))
+                models.Generator(realm=realm, allow_pauses=bool(i % 2)).save()
+                realms.append(realm)
+
+        response = self.assertConstantQueries(lambda: self.client.get(url),
+                                              add_realms)
+        data = response.data['results']
+        self.assertEqual(len(data), 6)
+        realm = realms[-1]
+
+        by_pk = {r['object_id']: r for r in data}
+        self.assertIsNone(by_pk[self.realm.pk]['generator'])
+        self.assertEqual(by_pk[realm.pk]['generator']['allow_pauses'], False)
+        self.assertEqual(by_pk[realm.pk]['generator']['content_type'],
+                         'sample_app.testrealm')
+
+    @override_settings(TURNGENERATION_PAGE_SIZE=2)
+    def test_pagination(self):
+        realms = [self.realm] + [
+            TestRealm.objects.create(slug='realm{0}'.format(i))
+            for i in range(4)
+        ]
+        url = reverse('realm_list',
+                      kwargs={'realm_alias': 'testrealm'})
+
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen.extend(r['object_id'] for r in response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual(seen, [realm.pk for realm in realms])
+
+    @patch.dict(TurnGeneration.permissions,
+                {'turngeneration.view_realm': '_is_host'})
+    def test_permitted(self):
+        url = reverse('realm_list',
+                      kwargs={'realm_alias': 'testrealm'})
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 0)
+
+        self.user.is_staff = True
+        self.user.save()
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
 
 
 class RealmRetrieveViewTestCase(APITestCase):
@@ -377,7 +470,7 @@ class GenerationRuleViewTestCase(APITestCase):
         self.assertEqual(response.data.get('freq'), 2)
 
 
-class AgentListViewTestCase(APITestCase):
+class AgentListViewTestCase(ConstantQueriesMixin, APITestCase):
     def setUp(self):
         self.user = User.objects.create_user(username='test',
                                              password='password')
@@ -434,7 +527,135 @@ class AgentListViewTestCase(APITestCase):
 
         response = self.client.get(realm_url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_constant_queries(self):
+        generator = models.Generator(realm=self.realm, autogenerate=False)
+        generator.save()
+        other = models.Generator(realm=TestRealm.objects.create(slug='other'))
+        other.save()
+
+        realm_url = reverse('agent_list',
+                            kwargs={'realm_alias': 'testrealm',
+                                    'realm_pk': self.realm.pk,
+                                    'agent_alias': 'testagent'})
+
+        agents = []
+
+        def add_agents():
+            for i in range(5):
+                agent = self.realm.agents.create(slug='agent{0}'.format(i))
+                agents.append(agent)
+                models.Pause.objects.create(generator=generator, agent=agent,
+                                            user=self.user, reason='Busy.')
+                models.Ready.objects.create(generator=generator, agent=agent,
+                                            user=self.user)
+            # A row for another Generator must not be picked up.
+            models.Ready.objects.create(generator=other, agent=self.agent)
+
+        response = self.assertConstantQueries(
+            lambda: self.client.get(realm_url), add_agents)
+        data = response.data['results']
+        self.assertEqual(len(data), 6)
+
+        by_pk = {a['object_id']: a for a in data}
+        self.assertIsNone(by_pk[self.agent.pk]['ready'])
+        self.assertIsNone(by_pk[self.agent.pk]['pause'])
+        self.assertEqual(by_pk[agents[-1].pk]['ready']['user'], 'test')
+        self.assertEqual(by_pk[agents[-1].pk]['pause']['reason'], 'Busy.')
+
+    @override_settings(TURNGENERATION_PAGE_SIZE=2)
+    def test_pagination(self):
+        generator = models.Generator(realm=self.realm)
+        generator.save()
+        agents = [self.agent] + [
+            self.realm.agents.create(slug='agent{0}'.format(i))
+            for i in range(4)
+        ]
+
+        realm_url = reverse('agent_list',
+                            kwargs={'realm_alias': 'testrealm',
+                                    'realm_pk': self.realm.pk,
+                                    'agent_alias': 'testagent'})
+
+        def page_through(url):
+            seen = []
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(len(response.data['results']), 2)
+                seen.extend(a['object_id'] for a in response.data['results'])
+                url = response.data['next']
+            return seen
+
+        self.assertEqual(page_through(realm_url),
+                         [agent.pk for agent in agents])
+
+        with patch.object(TurnGeneration, 'agent_ordering', create=True,
+                          return_value='-pk'):
+            self.assertEqual(page_through(realm_url),
+                             [agent.pk for agent in reversed(agents)])
+
+    @patch.dict(TurnGeneration.permissions,
+                {'turngeneration.view_agent': '_is_player'})
+    def test_permitted(self):
+        generator = models.Generator(realm=self.realm)
+        generator.save()
+        alice = self.realm.agents.create(slug='alice', user=self.user)
+
+        realm_url = reverse('agent_list',
+                            kwargs={'realm_alias': 'testrealm',
+                                    'realm_pk': self.realm.pk,
+                                    'agent_alias': 'testagent'})
+
+        with patch.object(TurnGeneration, '_is_player') as is_player:
+            response = self.client.get(realm_url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([a['object_id'] for a in response.data['results']], [alice.pk])
+            self.assertFalse(is_player.called)
+
+    @patch.dict(TurnGeneration.permissions,
+                {'turngeneration.view_agent': '_is_player'})
+    def test_permitted_fallback(self):
+        generator = models.Generator(realm=self.realm)
+        generator.save()
+        alice = self.realm.agents.create(slug='alice', user=self.user)
+
+        realm_url = reverse('agent_list',
+                            kwargs={'realm_alias': 'testrealm',
+                                    'realm_pk': self.realm.pk,
+                                    'agent_alias': 'testagent'})
+
+        with patch.object(TurnGeneration, 'filter_permitted', None):
+            response = self.client.get(realm_url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([a['object_id'] for a in response.data['results']], [alice.pk])
+
+    @override_settings(TURNGENERATION_PAGE_SIZE=2)
+    @patch.dict(TurnGeneration.permissions,
+                {'turngeneration.view_agent': '_is_player'})
+    def test_permitted_fallback_per_page(self):
+        generator = models.Generator(realm=self.realm)
+        generator.save()
+        for i in range(3):
+            self.realm.agents.create(slug='extra{0}'.format(i))
+
+        realm_url = reverse('agent_list',
+                            kwargs={'realm_alias': 'testrealm',
+                                    'realm_pk': self.realm.pk,
+                                    'agent_alias': 'testagent'})
+
+        # Only the agents on the page returned are checked.
+        with patch.object(TurnGeneration, 'filter_permitted', None):
+            with patch.object(TurnGeneration, '_is_player',
+                              return_value=True) as is_player:
+                response = self.client.get(realm_url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(is_player.call_count, 2)
+        self.assertIsNotNone(response.data['next'])
 
 
 class AgentRetrieveViewTestCase(APITestCase):
@@ -1131,3 +1352,460 @@ class ReadyViewTestCase(APITestCase):
         self.assertEqual(response.status_code, 404)
 
         self.assertEqual(models.Ready.objects.count(), 0)
+
+
+class ConditionalGetTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test',
+                                             password='password')
+        self.realm = TestRealm.objects.create(slug='500years')
+        self.agent = self.realm.agents.create(slug='agent1', user=self.user)
+        self.generator = models.Generator(realm=self.realm,
+                                          autogenerate=False)
+        self.generator.save()
+        self.assertTrue(self.client.login(username='test', password='password'))
+
+        self.generator_url = reverse('generator',
+                                     kwargs={'realm_alias': 'testrealm',
+                                             'realm_pk': self.realm.pk})
+
+    def assertNotModified(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def assertModified(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_generator(self):
+        response = self.client.get(self.generator_url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        self.assertNotModified(self.generator_url, etag)
+
+        # Only the session, the user and the realm are looked up.
+        with self.assertNumQueries(3):
+            self.assertNotModified(self.generator_url, etag)
+
+        self.generator.allow_pauses = False
+        self.generator.save()
+        etag = self.assertModified(self.generator_url, etag)
+
+        models.Ready.objects.create(generator=self.generator, agent=self.agent)
+        etag = self.assertModified(self.generator_url, etag)
+
+        models.Pause.objects.create(generator=self.generator, agent=self.agent)
+        etag = self.assertModified(self.generator_url, etag)
+
+        self.generator.rules.create(freq=2)
+        etag = self.assertModified(self.generator_url, etag)
+        self.assertNotModified(self.generator_url, etag)
+
+    def test_last_modified(self):
+        # Not while changes may yet be made in the same second.
+        response = self.client.get(self.generator_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+
+        with patch('turngeneration.views.time') as clock:
+            clock.time.return_value = time.time() + 1
+
+            response = self.client.get(self.generator_url)
+            self.assertEqual(response.status_code, 200)
+            last_modified = response['Last-Modified']
+
+            response = self.client.get(
+                self.generator_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 304)
+
+    def test_not_found(self):
+        url = reverse('generator', kwargs={'realm_alias': 'testrealm',
+                                           'realm_pk': self.realm.pk + 1})
+
+        with patch('turngeneration.views.time') as clock:
+            clock.time.return_value = time.time() + 1
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404)
+            self.assertNotIn('ETag', response)
+            self.assertNotIn('Last-Modified', response)
+
+            # Nor for errors returned rather than raised by the view.
+            with patch.object(views.GeneratorView, 'retrieve',
+                              return_value=Response(status=404)):
+                response = self.client.get(self.generator_url)
+            self.assertEqual(response.status_code, 404)
+            self.assertNotIn('ETag', response)
+            self.assertNotIn('Last-Modified', response)
+
+    def test_generation(self):
+        response = self.client.get(self.generator_url)
+        etag = response['ETag']
+
+        with patch('turngeneration.tasks.dispatch_timed_generation'):
+            from .. import tasks
+            tasks.timed_generation(self.generator.pk)
+
+        self.assertModified(self.generator_url, etag)
+
+    def test_other_views(self):
+        urls = [
+            reverse('realm_detail', kwargs={'realm_alias': 'testrealm',
+                                            'pk': self.realm.pk}),
+            reverse('generation_rules_list',
+                    kwargs={'realm_alias': 'testrealm',
+                            'realm_pk': self.realm.pk}),
+            reverse('agent_list', kwargs={'realm_alias': 'testrealm',
+                                          'realm_pk': self.realm.pk,
+                                          'agent_alias': 'testagent'}),
+        ]
+        etags = [self.client.get(url)['ETag'] for url in urls]
+        for url, etag in zip(urls, etags):
+            self.assertNotModified(url, etag)
+
+        self.realm.agents.create(slug='agent2')
+        for url, etag in zip(urls, etags):
+            self.assertModified(url, etag)
+
+    def test_realm(self):
+        url = reverse('realm_detail', kwargs={'realm_alias': 'testrealm',
+                                              'pk': self.realm.pk})
+        etag = self.client.get(url)['ETag']
+
+        self.realm.slug = 'renamed'
+        self.realm.save()
+        etag = self.assertModified(url, etag)
+
+        self.realm.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 404)
+
+    def test_per_user(self):
+        response = self.client.get(self.generator_url)
+        etag = response['ETag']
+
+        User.objects.create_user(username='other', password='password')
+        self.assertTrue(self.client.login(username='other',
+                                          password='password'))
+        self.assertModified(self.generator_url, etag)
+
+
+@override_settings(TURNGENERATION_RESPONSE_CACHE_TIMEOUT=60)
+class ResponseCacheTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='test',
+                                             password='password')
+        self.realm = TestRealm.objects.create(slug='500years')
+        self.agent = self.realm.agents.create(slug='agent1', user=self.user)
+        self.generator = models.Generator(realm=self.realm,
+                                          autogenerate=False)
+        self.generator.save()
+        self.assertTrue(self.client.login(username='test', password='password'))
+
+        self.rules_url = reverse('generation_rules_list',
+                                 kwargs={'realm_alias': 'testrealm',
+                                         'realm_pk': self.realm.pk})
+
+    def test_cached(self):
+        url = reverse('generator', kwargs={'realm_alias': 'testrealm',
+                                           'realm_pk': self.realm.pk})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['allow_pauses'], True)
+
+        # Only the session, the user and the realm are looked up.
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['allow_pauses'], True)
+
+        self.generator.allow_pauses = False
+        self.generator.save()
+        response = self.client.get(url)
+        self.assertEqual(response.data['allow_pauses'], False)
+
+    def test_invalidation(self):
+        response = self.client.get(self.rules_url)
+        self.assertEqual(len(response.data), 0)
+
+        rule = self.generator.rules.create(freq=2)
+        response = self.client.get(self.rules_url)
+        self.assertEqual(len(response.data), 1)
+
+        rule.delete()
+        response = self.client.get(self.rules_url)
+        self.assertEqual(len(response.data), 0)
+
+    def test_realm(self):
+        url = reverse('realm_detail', kwargs={'realm_alias': 'testrealm',
+                                              'pk': self.realm.pk})
+        with patch.object(TestRealm, '__repr__', lambda self: self.slug):
+            response = self.client.get(url)
+            self.assertEqual(response.data['repr'], '500years')
+
+            self.realm.slug = 'renamed'
+            self.realm.save()
+            response = self.client.get(url)
+            self.assertEqual(response.data['repr'], 'renamed')
+
+        self.realm.delete()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_permissions(self):
+        response = self.client.get(self.rules_url)
+        self.assertEqual(response.status_code, 200)
+
+        self.client.logout()
+        response = self.client.get(self.rules_url)
+        self.assertEqual(response.status_code, 403)
+
+
+class BulkReadyViewTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test',
+                                             password='password')
+        self.realm = TestRealm.objects.create(slug='500years')
+        self.agents = [
+            self.realm.agents.create(slug='agent{0}'.format(i), user=self.user)
+            for i in range(3)
+        ]
+        self.generator = models.Generator(realm=self.realm)
+        self.generator.save()
+        self.assertTrue(self.client.login(username='test', password='password'))
+
+        self.url = reverse('bulk_ready',
+                           kwargs={'realm_alias': 'testrealm',
+                                   'realm_pk': self.realm.pk})
+
+    def test_ready(self):
+        pks = [agent.pk for agent in self.agents]
+        models.Ready.objects.create(generator=self.generator,
+                                    agent=self.agents[0])
+
+        with patch('turngeneration.tasks.dispatch_ready_generation') as dispatch:
+            response = self.client.post(
+                self.url, {'agent_type': 'testagent', 'agents': pks},
+                format='json')
+        self.assertEqual(response.status_code, 200)
+        dispatch.assert_called_once_with(self.generator.pk)
+
+        self.assertEqual(
+            sorted(self.generator.readies.values_list('object_id', flat=True)),
+            pks)
+        self.generator.refresh_from_db()
+        self.assertEqual(self.generator.ready_count, 3)
+
+    def test_unready(self):
+        pks = [agent.pk for agent in self.agents]
+        with patch('turngeneration.tasks.dispatch_ready_generation'):
+            self.generator.mark_ready(
+                ContentType.objects.get_for_model(TestAgent), pks)
+
+        response = self.client.post(
+            self.url, {'agent_type': 'testagent', 'agents': pks[:2],
+                       'ready': False},
+            format='json')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(
+            list(self.generator.readies.values_list('object_id', flat=True)),
+            pks[2:])
+        self.generator.refresh_from_db()
+        self.assertEqual(self.generator.ready_count, 1)
+
+    def test_invalid(self):
+        response = self.client.post(
+            self.url, {'agent_type': 'starsrace', 'agents': [1]},
+            format='json')
+        self.assertEqual(response.status_code, 400)
+
+        other = TestRealm.objects.create(slug='other')
+        stranger = other.agents.create(slug='stranger', user=self.user)
+        response = self.client.post(
+            self.url, {'agent_type': 'testagent',
+                       'agents': [self.agents[0].pk, stranger.pk]},
+            format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.generator.readies.exists())
+
+    def test_permissions(self):
+        self.agents[1].user = None
+        self.agents[1].save()
+
+        response = self.client.post(
+            self.url, {'agent_type': 'testagent',
+                       'agents': [agent.pk for agent in self.agents]},
+            format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.generator.readies.exists())
+
+        self.client.logout()
+        response = self.client.post(
+            self.url, {'agent_type': 'testagent',
+                       'agents': [self.agents[0].pk]},
+            format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.generator.readies.exists())
+
+    def test_superuser(self):
+        User.objects.create_superuser(username='admin', email='',
+                                      password='password')
+        self.assertTrue(self.client.login(username='admin', password='password'))
+
+        pks = [agent.pk for agent in self.agents]
+        with patch('turngeneration.tasks.dispatch_ready_generation'):
+            response = self.client.post(
+                self.url, {'agent_type': 'testagent', 'agents': pks},
+                format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.generator.readies.count(), 3)
+
+
+class RealmStatusViewTestCase(ConstantQueriesMixin, APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test',
+                                             password='password')
+        self.assertTrue(self.client.login(username='test', password='password'))
+        self.url = reverse('realm_status', kwargs={'realm_alias': 'testrealm'})
+
+    def create_realm(self, agents=2, readies=1, pauses=0):
+        realm = TestRealm.objects.create(slug='realm')
+        generator = models.Generator(realm=realm, autogenerate=False)
+        generator.save()
+        for i in range(agents):
+            agent = realm.agents.create(slug='agent{0}'.format(i))
+            if i < readies:
+                models.Ready.objects.create(generator=generator, agent=agent)
+            if i < pauses:
+                models.Pause.objects.create(generator=generator, agent=agent)
+        return realm
+
+    def test_status(self):
+        realms = [self.create_realm(agents=3, readies=i, pauses=2 - i)
+                  for i in range(3)]
+        bare = TestRealm.objects.create(slug='bare')
+        ids = [realms[2].pk, bare.pk, realms[0].pk, realms[1].pk, 999]
+
+        response = self.client.get(
+            self.url, {'ids': ','.join(str(pk) for pk in ids)})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual([r['object_id'] for r in response.data], ids[:-1])
+        self.assertIsNone(response.data[1]['generator'])
+        self.assertEqual(
+            [(r['generator']['ready_count'], r['generator']['agent_count'],
+              r['generator']['pause_count'])
+             for r in response.data if r['generator']],
+            [(2, 3, 0), (0, 3, 2), (1, 3, 1)]
+        )
+
+    def test_stored_counts(self):
+        from sample_app.plugins import TurnGeneration
+
+        realm = self.create_realm(agents=3, readies=1, pauses=2)
+
+        # Without related_agents_lookup(), or on Django 1.10, the stored
+        # counters are used.
+        with patch.object(TurnGeneration, 'related_agents_lookup',
+                          return_value=None):
+            response = self.client.get(self.url, {'ids': str(realm.pk)})
+        self.assertEqual(response.status_code, 200)
+
+        generator = response.data[0]['generator']
+        self.assertEqual((generator['ready_count'], generator['agent_count'],
+                          generator['pause_count']), (1, 3, 2))
+
+        with patch('django.VERSION', (1, 10, 8, 'final', 0)):
+            with patch.object(models.GeneratorQuerySet, 'annotate_ready',
+                              side_effect=NotImplementedError):
+                response = self.client.get(self.url, {'ids': str(realm.pk)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]['generator']['pause_count'], 2)
+
+    def test_constant_queries(self):
+        realms = [self.create_realm()]
+
+        def request():
+            ids = ','.join(str(realm.pk) for realm in realms)
+            return self.client.get(self.url, {'ids': ids})
+
+        def add_realms():
+            realms.extend(self.create_realm(pauses=1) for i in range(5))
+
+        response = self.assertConstantQueries(request, add_realms)
+        self.assertEqual(len(response.data), 6)
+
+    def test_invalid(self):
+        response = self.client.get(self.url, {'ids': '1,two'})
+        self.assertEqual(response.status_code, 400)
+
+        with override_settings(TURNGENERATION_PAGE_SIZE=2):
+            response = self.client.get(self.url, {'ids': '1,2,3'})
+        self.assertEqual(response.status_code, 400)
+
+        url = reverse('realm_status', kwargs={'realm_alias': 'starsweb'})
+        response = self.client.get(url, {'ids': '1'})
+        self.assertEqual(response.status_code, 404)
+
+
+class UserAgentsViewTestCase(ConstantQueriesMixin, APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test',
+                                             password='password')
+        self.assertTrue(self.client.login(username='test', password='password'))
+        self.url = reverse('user_agents')
+
+    def create_game(self, ready=False, paused=False):
+        realm = TestRealm.objects.create(slug='realm')
+        generator = models.Generator(realm=realm, autogenerate=False)
+        generator.save()
+        agent = realm.agents.create(slug='mine', user=self.user)
+        realm.agents.create(slug='theirs')
+        if ready:
+            models.Ready.objects.create(generator=generator, agent=agent,
+                                        user=self.user)
+        if paused:
+            models.Pause.objects.create(generator=generator, agent=agent,
+                                        user=self.user, reason='Away.')
+        return agent
+
+    def test_agents(self):
+        agents = [self.create_game(ready=True), self.create_game(paused=True)]
+        # No Generator, and no realm at all.
+        agents.append(TestRealm.objects.create(slug='new').agents.create(
+            slug='mine', user=self.user))
+        TestAgent.objects.create(slug='lost', user=self.user)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([a['object_id'] for a in response.data],
+                         [agent.pk for agent in agents])
+
+        first, second, third = response.data
+        self.assertEqual(first['realm']['object_id'], agents[0].realm_id)
+        self.assertEqual(first['ready']['user'], 'test')
+        self.assertIsNone(first['pause'])
+        self.assertIsNone(second['ready'])
+        self.assertEqual(second['pause']['reason'], 'Away.')
+        self.assertIsNotNone(second['realm']['generator'])
+        self.assertIsNone(third['realm']['generator'])
+
+    def test_constant_queries(self):
+        self.create_game(ready=True)
+
+        def add_games():
+            for i in range(5):
+                self.create_game(ready=bool(i % 2), paused=not i % 2)
+
+        response = self.assertConstantQueries(
+            lambda: self.client.get(self.url), add_games)
+        self.assertEqual(len(response.data), 6)
+
+    def test_anonymous(self):
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
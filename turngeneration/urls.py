@@ -4,14 +4,25 @@ from . import views
 
 
 urlpatterns = [
+    url(r'^my-games/$', views.UserAgentsView.as_view(),
+        name='user_agents'),
     url(r'^(?P<realm_alias>[-\w]+)/$', views.RealmListView.as_view(),
         name='realm_list'),
+    url(r'^(?P<realm_alias>[-\w]+)/status/$',
+        views.RealmStatusView.as_view(),
+        name='realm_status'),
     url(r'^(?P<realm_alias>[-\w]+)/(?P<pk>\d+)/$',
         views.RealmRetrieveView.as_view(),
         name='realm_detail'),
     url(r'^(?P<realm_alias>[-\w]+)/(?P<realm_pk>\d+)/generator/$',
         views.GeneratorView.as_view(),
         name='generator'),
+    url(r'^(?P<realm_alias>[-\w]+)/(?P<realm_pk>\d+)/generator/events/$',
+        views.GeneratorEventsView.as_view(),
+        name='generator_events'),
+    url(r'^(?P<realm_alias>[-\w]+)/(?P<realm_pk>\d+)/generator/ready/$',
+        views.BulkReadyView.as_view(),
+        name='bulk_ready'),
     url(r'^(?P<realm_alias>[-\w]+)/(?P<realm_pk>\d+)/generator/rules/$',
         views.GenerationRuleListView.as_view(),
         name='generation_rules_list'),
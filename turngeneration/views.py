@@ -1,17 +1,23 @@
+import django
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.shortcuts import get_object_or_404
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.conf import settings
+from django.views.decorators.http import condition
 
 from rest_framework import generics, viewsets, mixins
-from rest_framework import status
+from rest_framework import permissions, status
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
 
+import datetime
+import hashlib
 import logging
+import time
 
-from . import models, forms, plugins, serializers
+from . import backends, cache, events, models, forms, pagination, plugins, serializers
 from .permissions import PluginPermissions
 
 logger = logging.getLogger(__name__)
@@ -39,6 +45,113 @@ class CrudAPIView(mixins.CreateModelMixin,
         return self.destroy(request, *args, **kwargs)
 
 
+class StateVersionMixin(object):
+    def get_state_version(self):
+        """
+        Return the version of the realm's turn generation state, which
+        is kept in the cache and so costs no queries, or None for an
+        unknown realm type.
+
+        """
+        if not hasattr(self, '_state_version'):
+            ct = plugins.realm_type(self.kwargs.get('realm_alias'))
+            realm_pk = self.kwargs.get('realm_pk', self.kwargs.get('pk'))
+            self._state_version = None if ct is None else cache.get_version(
+                'state', models.state_key(ct.pk, realm_pk))
+        return self._state_version
+
+
+class ConditionalGetMixin(StateVersionMixin):
+    """
+    Answers conditional GETs from the version of the realm's turn
+    generation state, without running the view itself when nothing has
+    changed.
+
+    """
+    def get(self, request, *args, **kwargs):
+        version = self.get_state_version()
+        if version is None:
+            return super(ConditionalGetMixin, self).get(
+                request, *args, **kwargs)
+
+        # Responses may depend on who is asking.
+        etag = '{0}-{1}'.format(version, request.user.pk or 0)
+
+        # HTTP dates only go down to the second, so a later change within
+        # the same second would pass for unmodified.  Only send one once
+        # that second is over.
+        last_modified = None
+        if int(time.time()) > version // 1000000:
+            last_modified = datetime.datetime.utcfromtimestamp(
+                version // 1000000)
+
+        view = condition(etag_func=lambda *a, **kw: etag,
+                         last_modified_func=lambda *a, **kw: last_modified)(
+            super(ConditionalGetMixin, self).get)
+        response = view(request, *args, **kwargs)
+
+        # Errors, such as for a realm that doesn't exist, aren't versioned.
+        if response.status_code not in (status.HTTP_200_OK,
+                                        status.HTTP_304_NOT_MODIFIED):
+            for header in ('ETag', 'Last-Modified'):
+                if response.has_header(header):
+                    del response[header]
+        return response
+
+
+class CachedResponseMixin(StateVersionMixin):
+    """
+    With `TURNGENERATION_RESPONSE_CACHE_TIMEOUT` set, keeps the data of
+    successful GETs in the cache under the version of the realm's turn
+    generation state, so that any change leaves them behind.  Entries are
+    kept per user, and only served once the permission checks pass.
+
+    """
+    def get(self, request, *args, **kwargs):
+        timeout = getattr(settings, 'TURNGENERATION_RESPONSE_CACHE_TIMEOUT', 0)
+        version = self.get_state_version()
+        if not timeout or version is None:
+            return super(CachedResponseMixin, self).get(
+                request, *args, **kwargs)
+
+        path = hashlib.md5(request.get_full_path().encode('utf-8'))
+        key = 'turngeneration:response:{0}:{1}:{2}'.format(
+            version, request.user.pk or 0, path.hexdigest())
+
+        data = cache.get_cache().get(key)
+        if data is not None:
+            return Response(data)
+
+        response = super(CachedResponseMixin, self).get(
+            request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.get_cache().set(key, response.data, timeout)
+        return response
+
+
+class PermittedListMixin(object):
+    # Lists only show the objects on which the user has this permission,
+    # for plugins that define it.
+    list_permission = None
+
+    def filter_queryset(self, queryset):
+        queryset = super(PermittedListMixin, self).filter_queryset(queryset)
+        if (self.paginator is not None and not backends.filters_in_database(
+                self.list_permission, queryset.model)):
+            # Checked object by object, so only for the page returned.
+            return queryset
+        return backends.filter_permitted(self.request.user,
+                                         self.list_permission, queryset)
+
+    def paginate_queryset(self, queryset):
+        page = super(PermittedListMixin, self).paginate_queryset(queryset)
+        if page is not None and not backends.filters_in_database(
+                self.list_permission, queryset.model):
+            page = backends.permitted_objects(self.request.user,
+                                              self.list_permission, page)
+        return page
+
+
 class RealmQuerysetMixin(object):
     serializer_class = serializers.RealmSerializer
 
@@ -50,12 +163,96 @@ class RealmQuerysetMixin(object):
         return ct.model_class().objects.all()
 
 
-class RealmListView(RealmQuerysetMixin, generics.ListAPIView):
+class RealmListView(PermittedListMixin, RealmQuerysetMixin,
+                    generics.ListAPIView):
     # /api/starsgame/
-    pass
+    list_permission = 'turngeneration.view_realm'
+    pagination_class = pagination.CursorPagination
+
+    def get_serializer(self, *args, **kwargs):
+        if kwargs.get('many') and args:
+            realms = list(args[0])
+            args = (realms,) + args[1:]
+
+            ct = ContentType.objects.get_for_model(self.get_queryset().model)
+            generators = models.Generator.objects.filter(
+                content_type=ct, object_id__in=[realm.pk for realm in realms]
+            ).select_related('content_type')
+            self._generators = {g.object_id: g for g in generators}
 
+        return super(RealmListView, self).get_serializer(*args, **kwargs)
 
-class RealmRetrieveView(RealmQuerysetMixin, generics.RetrieveAPIView):
+    def get_serializer_context(self):
+        context = super(RealmListView, self).get_serializer_context()
+        generators = getattr(self, '_generators', None)
+        if generators is not None:
+            context['generators'] = generators
+        return context
+
+
+class RealmStatusView(RealmQuerysetMixin, generics.GenericAPIView):
+    # /api/starsgame/status/?ids=3,5,8
+    serializer_class = serializers.RealmStatusSerializer
+
+    def get(self, request, *args, **kwargs):
+        try:
+            ids = [int(pk) for pk in
+                   request.query_params.get('ids', '').split(',') if pk]
+        except ValueError:
+            raise ValidationError({'ids': ["Expected a comma-separated list"
+                                           " of realm ids."]})
+        limit = getattr(settings, 'TURNGENERATION_PAGE_SIZE', 100)
+        if len(ids) > limit:
+            raise ValidationError({'ids': ["At most {0} realms may be"
+                                           " requested.".format(limit)]})
+
+        queryset = backends.filter_permitted(
+            request.user, 'turngeneration.view_realm',
+            self.get_queryset().filter(pk__in=ids))
+        found = set(queryset.values_list('pk', flat=True))
+        pks = [pk for pk in ids if pk in found]
+
+        ct = ContentType.objects.get_for_model(queryset.model)
+        generators = self.get_generators(ct, pks)
+
+        serializer = self.get_serializer(
+            [{'object_id': pk, 'generator': generators.get(pk)} for pk in pks],
+            many=True)
+        return Response(serializer.data)
+
+    def get_generators(self, ct, pks):
+        """
+        Fetch the Generators of the realms, with their counts of agents,
+        readies and pauses, in a single query.
+
+        """
+        from django.db.models import Count
+
+        queryset = models.Generator.objects.filter(
+            content_type=ct, object_id__in=pks
+        ).annotate(pause_count=Count('pauses'))
+
+        # Where the plugin allows, count the agents and readies afresh,
+        # in case the stored counters are due a recount.  This needs
+        # Django 1.11 or later; before that the stored counters serve.
+        plugin = plugins.get_plugin('{ct.app_label}.{ct.model}'.format(ct=ct))
+        lookup = getattr(plugin, 'related_agents_lookup', None)
+        recount = (django.VERSION >= (1, 11) and
+                   lookup is not None and lookup() is not None)
+        if recount:
+            queryset = queryset.annotate_ready()
+
+        generators = {}
+        for generator in queryset:
+            if recount:
+                generator.agent_count = generator.agents_total
+                generator.ready_count = generator.agents_ready
+            generators[generator.object_id] = generator
+        return generators
+
+
+class RealmRetrieveView(ConditionalGetMixin, CachedResponseMixin,
+                        RealmQuerysetMixin, generics.RetrieveAPIView):
     # /api/starsgame/3/
     pass
 
@@ -96,7 +293,8 @@ class GeneratorMixin(object):
         return self.get_realm()
 
 
-class GeneratorView(GeneratorMixin, CrudAPIView):
+class GeneratorView(ConditionalGetMixin, CachedResponseMixin, GeneratorMixin,
+                    CrudAPIView):
     # /api/starsgame/3/generator/
     serializer_class = serializers.GeneratorSerializer
     queryset = models.Generator.objects.all()
@@ -122,7 +320,53 @@ class GeneratorView(GeneratorMixin, CrudAPIView):
         return generator
 
 
-class GenerationRuleListView(GeneratorMixin, generics.ListCreateAPIView):
+class GeneratorEventsView(GeneratorMixin, generics.GenericAPIView):
+    # /api/starsgame/3/generator/events/
+    queryset = models.Generator.objects.all()
+    permission_classes = (PluginPermissions,)
+    renderer_classes = ([events.EventStreamRenderer] +
+                        api_settings.DEFAULT_RENDERER_CLASSES)
+
+    def get(self, request, *args, **kwargs):
+        generator = self.get_generator(self.get_queryset())
+
+        # Subscribe before responding, so that no events are missed.
+        subscription = events.subscribe(generator.pk)
+        response = StreamingHttpResponse(self.stream(subscription),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def stream(self, subscription):
+        """
+        Relay the Generator's events for at most
+        `TURNGENERATION_EVENTS_TIMEOUT` seconds, after which the client
+        is expected to reconnect, sending comments in quiet periods to
+        keep the connection open.
+
+        """
+        timeout = getattr(settings, 'TURNGENERATION_EVENTS_TIMEOUT', 300)
+        keepalive = getattr(settings, 'TURNGENERATION_EVENTS_KEEPALIVE', 15)
+        deadline = time.time() + timeout
+
+        try:
+            yield 'retry: 1000\n\n'
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                message = subscription.get(timeout=min(keepalive, remaining))
+                if message is None:
+                    yield ':\n\n'
+                else:
+                    yield events.format_event(message)
+        finally:
+            subscription.close()
+
+
+class GenerationRuleListView(ConditionalGetMixin, CachedResponseMixin,
+                             GeneratorMixin, generics.ListCreateAPIView):
     # /api/starsgame/3/generator/rules/
     serializer_class = serializers.GenerationRuleSerializer
     queryset = models.GenerationRule.objects.all()
@@ -161,6 +405,109 @@ class GenerationRuleView(GeneratorMixin, generics.RetrieveUpdateDestroyAPIView):
         return generator.rules.all()
 
 
+class BulkReadyView(GeneratorMixin, generics.GenericAPIView):
+    # /api/starsgame/3/generator/ready/
+    serializer_class = serializers.BulkReadySerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        generator = self.get_generator(models.Generator.objects.all())
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        agent_type = plugins.agent_type(data['agent_type'])
+        plugin = (plugins.get_plugin_for_model(agent_type.model_class())
+                  if agent_type is not None else None)
+        queryset = (plugin.related_agents(generator.realm, agent_type)
+                    if plugin is not None else None)
+        if queryset is None:
+            raise ValidationError({'agent_type': ["Unknown agent type."]})
+
+        # Check existence and permissions for all of the agents at once.
+        pks = set(data['agents'])
+        queryset = queryset.filter(pk__in=pks)
+        missing = pks - set(queryset.values_list('pk', flat=True))
+        if missing:
+            raise ValidationError(
+                {'agents': ["Unknown agents: {0}.".format(
+                    ', '.join(str(pk) for pk in sorted(missing)))]})
+
+        perm = ('turngeneration.add_ready' if data['ready']
+                else 'turngeneration.delete_ready')
+        permitted = backends.filter_permitted(request.user, perm, queryset,
+                                              unlisted=False)
+        if permitted.count() < len(pks):
+            raise PermissionDenied
+
+        if data['ready']:
+            generator.mark_ready(agent_type, pks, user=request.user)
+        else:
+            generator.mark_unready(agent_type, pks)
+        return Response(serializer.data)
+
+
+class UserAgentsView(generics.GenericAPIView):
+    # /api/my-games/
+    serializer_class = serializers.UserAgentSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        data = []
+        for plugin in plugins.all_plugins():
+            if getattr(plugin, 'agents_for_user', None) is None:
+                continue
+            data.extend(self.serialize_agents(plugin))
+        return Response(data)
+
+    def serialize_agents(self, plugin):
+        """
+        Serialize the user's agents from `plugin`, along with their
+        realms, Generators, readies and pauses, in four queries.
+
+        """
+        agents = plugin.agents_for_user(self.request.user)
+        agent_ct = ContentType.objects.get_for_model(agents.model)
+        lookup = getattr(plugin, 'related_agents_lookup', None)
+        lookup = lookup(agent_ct) if lookup is not None else None
+        if lookup is None:
+            return []
+
+        field = agents.model._meta.get_field(lookup[1])
+        agents = [agent for agent in
+                  agents.select_related(field.name).order_by('pk')
+                  if getattr(agent, field.attname) is not None]
+        realms = {agent.pk: getattr(agent, field.name) for agent in agents}
+
+        realm_ct = ContentType.objects.get_for_model(field.related_model)
+        generators = models.Generator.objects.filter(
+            content_type=realm_ct,
+            object_id__in=set(realm.pk for realm in realms.values())
+        ).select_related('content_type')
+        generators = {g.object_id: g for g in generators}
+
+        # Only the rows for the Generator of the agent's own realm count.
+        def rows(queryset):
+            rows = {}
+            for row in queryset.filter(
+                    content_type=agent_ct,
+                    object_id__in=[agent.pk for agent in agents],
+                    generator__in=list(generators.values())
+            ).select_related('content_type', 'user'):
+                generator = generators.get(realms[row.object_id].pk)
+                if generator is not None and generator.pk == row.generator_id:
+                    rows[row.content_type_id, row.object_id] = row
+            return rows
+
+        context = self.get_serializer_context()
+        context.update(realms=realms, generators=generators,
+                       pauses=rows(models.Pause.objects.all()),
+                       readies=rows(models.Ready.objects.all()))
+        serializer_class = self.get_serializer_class()
+        return serializer_class(agents, many=True, context=context).data
+
+
 class AgentQuerysetMixin(object):
     def get_queryset(self):
         generator = self.get_generator(models.Generator.objects.all())
@@ -179,10 +526,38 @@ class AgentQuerysetMixin(object):
             raise Http404
         return queryset
 
+    def get_serializer_context(self):
+        context = super(AgentQuerysetMixin, self).get_serializer_context()
+        generator = self.get_generator(models.Generator.objects.all())
+        context['generator'] = generator
+        return context
+
 
-class AgentListView(AgentQuerysetMixin, GeneratorMixin, generics.ListAPIView):
+class AgentListView(ConditionalGetMixin, PermittedListMixin,
+                    AgentQuerysetMixin, GeneratorMixin, generics.ListAPIView):
     # /api/starsgame/3/starsrace/
     serializer_class = serializers.AgentSerializer
+    list_permission = 'turngeneration.view_agent'
+    pagination_class = pagination.CursorPagination
+
+    def get_cursor_ordering(self):
+        agent_type = plugins.agent_type(self.kwargs.get('agent_alias'))
+        plugin = plugins.get_plugin_for_model(agent_type.model_class())
+        agent_ordering = getattr(plugin, 'agent_ordering', None)
+        if agent_ordering is None:
+            return 'pk'
+        return agent_ordering(agent_type)
+
+    def get_serializer_context(self):
+        context = super(AgentListView, self).get_serializer_context()
+        generator = context['generator']
+        pauses = generator.pauses.select_related('content_type', 'user')
+        readies = generator.readies.select_related('content_type', 'user')
+        context['pauses'] = {(p.content_type_id, p.object_id): p
+                             for p in pauses}
+        context['readies'] = {(r.content_type_id, r.object_id): r
+                              for r in readies}
+        return context
 
 
 class AgentRetrieveView(AgentQuerysetMixin, GeneratorMixin,